@@ -11,11 +11,22 @@ import os
 import pandas as pd
 import numpy as np
 import json
+import gzip
+import sqlite3
+import unicodedata
 from csv import reader
 from loguru import logger
 import time
+from array import array
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
+# pyarrow is only needed for the (optional) Parquet output
+try:
+    import pyarrow
+except ImportError:
+    pyarrow = None
 
 # Show all data in screen
 pd.set_option("display.max.columns", None)
@@ -29,10 +40,609 @@ runyear = str(datetime.today().year)
 now = str(datetime.now())
 nowt = time.time()
 
-logger.add(r'U:\Werk\Data Management\Python\\Files\output\EBA_Process_'+runday+'.log', backtrace=True, diagnose=True, rotation="10 MB", retention="12 months")
-@logger.catch()
+# The property fields of an entity in the order of the original Json download file.
+# WARNING: The number of fields may depend on the size of the download as this depends
+# on what data is included in the Json File! I have based it on the full register
+# download file. Properties that are not in this list are added as extra columns at the end.
+PROPERTY_FIELDS = ['ENT_AUT', 'ENT_NAT_REF_COD', 'ENT_NAM', 'ENT_ADD', 'ENT_TOW_CIT_RES', 'ENT_POS_COD',
+                   'ENT_COU_RES', 'EntityCode', 'ENT_NAM_COM', 'ENT_EXC', 'ENT_DES_ACT_EXC_SCP',
+                   'ENT_TYP_PAR_ENT', 'ENT_COD_PAR_ENT', 'DER_CHI_ENT_AUT']
 
-def main():
+# Some properties can have more than one value for an entity. ENT_AUT is a list and an entity
+# can have several commercial names (ENT_NAM_COM). These values are put in one cell,
+# without duplicates and in the order of the download, separated by the following characters.
+MULTI_VALUE_SEPARATOR = ' | '
+
+# Function that combines all values found for one property of an entity into one cell
+def collapse_values(values):
+    values = [str(value) for value in values if value is not None and value != '']
+    if not values:
+        return None
+    return MULTI_VALUE_SEPARATOR.join(dict.fromkeys(values))
+
+# Function that turns the list of properties (list of dictionaries) of one entity into a
+# single row: a dictionary with the property name and the (combined) property value.
+def entity_properties(l1):
+    found = {}
+    for record in l1['Properties']:
+        for key, value in record.items():
+            if isinstance(value, list):
+                found.setdefault(key, []).extend(value)
+            else:
+                found.setdefault(key, []).append(value)
+    row = {key: collapse_values(values) for key, values in found.items()}
+    row['EntityCode'] = l1['EntityCode']
+    return row
+
+# Function that gets the base data (step 4) of one entity as a row (dictionary)
+def entity_base(l1):
+    return {'ID': l1['CA_OwnerID'], 'EntityCode': l1['EntityCode'], 'EntityType': l1['EntityType'],
+            'EBA_Entity_Version': l1['__EBA_EntityVersion']}
+
+# Function that gets the services (step 6) of one entity as a list of rows with three items:
+# Entity Code, CountryCode, ServiceCode. Only active entities have services.
+def entity_services(l1):
+    rows = []
+    for dataitem in l1.get('Services', []):
+        for country in dataitem:
+            for service_code in dataitem[country]:
+                rows.append((l1['EntityCode'], country, service_code))
+    return rows
+
+# Function that extracts everything needed for the three tables from one entity
+def extract_entity(l1):
+    return entity_base(l1), entity_properties(l1), entity_services(l1)
+
+# The columns of the services table. These hold millions of repeated short codes, so they are
+# collected as integer codes (one code per different value) and stored as categoricals.
+SERVICE_COLUMNS = ['EntityCode', 'EntityCountryServCode', 'EntityServType']
+
+# Function that creates the column lists for the three tables: entities, properties and services.
+# The tables are collected in one list per column and only turned into a DataFrame at the end.
+# Each services column is an array of integer codes plus a dictionary with the code of each value.
+def new_register_tables():
+    return {'entities': {'ID': [], 'EntityCode': [], 'EntityType': [], 'EBA_Entity_Version': []},
+            'properties': {field: [] for field in PROPERTY_FIELDS},
+            'services': {column: (array('i'), {}) for column in SERVICE_COLUMNS}}
+
+# Function that adds a row (dictionary) to a table that is collected in column lists.
+# A column that shows up for the first time gets empty cells for the earlier rows.
+def append_row(columns, row):
+    rownr = len(columns['EntityCode'])
+    for key in row:
+        if key not in columns:
+            logger.debug('Property not in the list of expected properties: ' + key)
+            columns[key] = [None] * rownr
+    for key, values in columns.items():
+        values.append(row.get(key))
+
+# Function that adds a value to a column of integer codes. Every different value gets its own code.
+def append_code(column, value):
+    codes, categories = column
+    code = categories.get(value)
+    if code is None:
+        code = categories[value] = len(categories)
+    codes.append(code)
+
+# Function that adds the extracted data of one entity to the three tables
+def add_entity(tables, extracted):
+    base, props, services = extracted
+    append_row(tables['entities'], base)
+    append_row(tables['properties'], props)
+    serv_columns = [tables['services'][column] for column in SERVICE_COLUMNS]
+    for service in services:
+        for column, value in zip(serv_columns, service):
+            append_code(column, value)
+
+# Function that turns the collected column lists into the three DataFrames / tables
+def build_register_tables(tables):
+    services = {column: pd.Categorical.from_codes(np.frombuffer(codes, dtype=np.int32), categories=list(categories))
+                for column, (codes, categories) in tables['services'].items()}
+    return (pd.DataFrame(tables['entities']), pd.DataFrame(tables['properties']),
+            pd.DataFrame(services))
+
+# Function that turns the services table into a compact bitset form: one row per entity and
+# country with a number (Services) in which bit n is set if the entity provides service n
+# in that country. Service n is the n-th category of EntityServType.
+# Returns the bitset table and the list of services (the meaning of each bit).
+def services_bitset(Serv_Entities):
+    service_types = Serv_Entities['EntityServType'].cat.categories
+    if len(service_types) > 64:
+        raise ValueError(f'Too many different services for a bitset: {len(service_types)}')
+    dtype = next(dtype for dtype in (np.uint8, np.uint16, np.uint32, np.uint64) if np.iinfo(dtype).bits >= len(service_types))
+    entity = Serv_Entities['EntityCode'].cat.codes.to_numpy(dtype=np.int64)
+    country = Serv_Entities['EntityCountryServCode'].cat.codes.to_numpy(dtype=np.int64)
+    bits = np.left_shift(np.uint64(1), Serv_Entities['EntityServType'].cat.codes.to_numpy(dtype=np.uint64))
+
+    # Sort the rows on entity and country and combine the bits of each entity + country
+    key = entity * len(Serv_Entities['EntityCountryServCode'].cat.categories) + country
+    order = np.argsort(key, kind='stable')
+    key = key[order]
+    starts = np.flatnonzero(np.r_[True, key[1:] != key[:-1]]) if len(key) else np.array([], dtype=np.int64)
+    combined = np.bitwise_or.reduceat(bits[order], starts) if len(key) else bits
+    first = order[starts]
+    bitset = pd.DataFrame({'EntityCode': Serv_Entities['EntityCode'].iloc[first].reset_index(drop=True),
+                           'EntityCountryServCode': Serv_Entities['EntityCountryServCode'].iloc[first].reset_index(drop=True),
+                           'Services': combined.astype(dtype)})
+    return bitset, list(service_types)
+
+# Function that gives the entities (with the country) that provide a service in a country (for example
+# PS_03 into DE) or in any country (country None) using the bitset form of the services table.
+# This is a single vectorized mask operation.
+def entities_with_service(bitset, service_types, service, country=None):
+    if service not in service_types:
+        return bitset.loc[[], ['EntityCode', 'EntityCountryServCode']]
+    bit = bitset['Services'].dtype.type(1 << service_types.index(service))
+    mask = (bitset['Services'].to_numpy() & bit) != 0
+    if country:
+        mask &= (bitset['EntityCountryServCode'] == country).to_numpy()
+    return bitset.loc[mask, ['EntityCode', 'EntityCountryServCode']].reset_index(drop=True)
+
+# Name of the services bitset file in the output folder (next to the csv files). It makes the
+# Service lookup possible without the query database.
+SERVICES_BITSET = 'EBA_PIR_services_bitset.npz'
+
+# Function that saves the bitset form of the services table as a compressed numpy file:
+# the categories and codes of EntityCode and EntityCountryServCode, the bitsets and the services
+def save_services_bitset(bitsetfile, bitset, service_types):
+    arrays = {'Services': bitset['Services'].to_numpy(), 'service_types': np.array(service_types, dtype=str)}
+    for column in ('EntityCode', 'EntityCountryServCode'):
+        arrays[column + '_categories'] = np.array(bitset[column].cat.categories, dtype=str)
+        arrays[column + '_codes'] = bitset[column].cat.codes.to_numpy()
+    np.savez_compressed(bitsetfile, **arrays)
+
+# Function that reads a saved services bitset file. Returns the bitset table and the list of services.
+def load_services_bitset(bitsetfile):
+    with np.load(bitsetfile) as arrays:
+        bitset = pd.DataFrame({column: pd.Categorical.from_codes(arrays[column + '_codes'], arrays[column + '_categories'])
+                               for column in ('EntityCode', 'EntityCountryServCode')})
+        bitset['Services'] = arrays['Services']
+        return bitset, list(arrays['service_types'])
+
+# Number of entities in one shard (part of the register) that is processed at a time
+SHARD_SIZE = 5000
+
+# Function that splits the stream of entities into shards (lists) of SHARD_SIZE entities
+def iter_shards(entities, shard_size=SHARD_SIZE):
+    shard = []
+    for l1 in entities:
+        shard.append(l1)
+        if len(shard) == shard_size:
+            yield shard
+            shard = []
+    if shard:
+        yield shard
+
+# Function that extracts the data of a shard (list) of entities. This can run in a separate process.
+def extract_shard(shard):
+    return [extract_entity(l1) for l1 in shard]
+
+# Function that walks through the entities once and feeds every entity to the extractors
+# of the entities (step 4), properties (step 5) and services (step 6) tables.
+# With more than one process the shards are divided over a process pool. The results are
+# added in the order of the shards, so the tables are the same as with a single process.
+# Only a limited number of shards is read ahead to keep the memory use flat.
+#
+# The state (see load_state) of a previous run can be provided. Entities with the same
+# __EBA_EntityVersion as in the previous run are not extracted again: the rows of the previous
+# run are used. Entities that are no longer in the register are left out.
+# Returns the three tables and the new state for the next run.
+def extract_register(entities, processes=1, state=None):
+    state = state or {}
+    tables = new_register_tables()
+    new_state = {}
+    shardnr = 0
+    reused = 0
+
+    # Split a shard in entities that can be taken from the previous run and entities that need to be extracted
+    def prepare_shard(shard):
+        nonlocal reused
+        items = []
+        todo = []
+        for l1 in shard:
+            version = l1['__EBA_EntityVersion']
+            previous = state.get(l1['EntityCode'])
+            if previous is not None and previous[0] == version:
+                items.append((l1['EntityCode'], version, previous[1:]))
+                reused += 1
+            else:
+                items.append((l1['EntityCode'], version, None))
+                todo.append(l1)
+        return items, todo
+
+    # Add the entities of a shard to the tables (in the order of the download) and to the new state
+    def add_shard(items, extracted):
+        extracted = iter(extracted)
+        for entitycode, version, previous in items:
+            rows = previous if previous is not None else next(extracted)
+            add_entity(tables, rows)
+            new_state[entitycode] = [version, *rows]
+
+    if processes <= 1:
+        for shard in iter_shards(entities):
+            shardnr += 1
+            logger.debug(f'Processing EBA entities shard {shardnr}: {len(shard)} entities')
+            items, todo = prepare_shard(shard)
+            add_shard(items, extract_shard(todo))
+    else:
+        with ProcessPoolExecutor(max_workers=processes) as executor:
+            running = deque()
+            for shard in iter_shards(entities):
+                shardnr += 1
+                logger.debug(f'Processing EBA entities shard {shardnr}: {len(shard)} entities')
+                items, todo = prepare_shard(shard)
+                running.append((items, executor.submit(extract_shard, todo)))
+                if len(running) >= processes * 2:
+                    items, future = running.popleft()
+                    add_shard(items, future.result())
+            while running:
+                items, future = running.popleft()
+                add_shard(items, future.result())
+
+    if state:
+        removed = sum(1 for entitycode in state if entitycode not in new_state)
+        logger.debug(f'Entities unchanged since the previous run: {reused}, new or changed: {len(new_state) - reused}, removed: {removed}')
+    return (*build_register_tables(tables), new_state)
+
+# Function that reads the state of a previous run: for each EntityCode the __EBA_EntityVersion
+# and the extracted rows. Returns an empty state if there is no state file (yet).
+def load_state(statefile):
+    if not os.path.exists(statefile):
+        return {}
+    with gzip.open(statefile, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+# Function that saves the state of this run so the next download only needs the changed entities
+def save_state(statefile, state):
+    with gzip.open(statefile, 'wt', encoding='utf-8') as f:
+        json.dump(state, f)
+
+# Number of characters that are read from the Json file at a time
+READ_CHUNK_SIZE = 1024 * 1024
+
+# Function that reads the entities one at a time from the Json download instead of loading
+# the whole file (several hundreds of MB) in memory. The download is a list with as the first
+# item a copyright notice (etc.) which is skipped. The entities are in the second (list) item.
+def iter_register_entities(namefile, chunk_size=READ_CHUNK_SIZE):
+    decoder = json.JSONDecoder()
+    with open(namefile, 'r', encoding='utf-8-sig') as f:
+        buffer = ''
+        pos = 0
+        end_of_file = False
+
+        # Go to the next character that is not a space / new line. Reads more data if needed.
+        def next_char():
+            nonlocal pos
+            while True:
+                while pos < len(buffer) and buffer[pos].isspace():
+                    pos += 1
+                if pos < len(buffer) or end_of_file:
+                    return buffer[pos] if pos < len(buffer) else ''
+                more_data()
+
+        def more_data():
+            nonlocal buffer, pos, end_of_file
+            chunk = f.read(chunk_size)
+            if not chunk:
+                end_of_file = True
+            buffer = buffer[pos:] + chunk
+            pos = 0
+
+        def expect(character):
+            nonlocal pos
+            found = next_char()
+            if found != character:
+                raise ValueError(f'Unexpected content in Json file {namefile}: expected "{character}" but found "{found}"')
+            pos += 1
+
+        # Read one complete Json item (for example an entity). If the item is not complete
+        # in the data read so far, more data is read and the item is read again.
+        def read_item():
+            nonlocal pos
+            next_char()
+            while True:
+                try:
+                    item, pos = decoder.raw_decode(buffer, pos)
+                    return item
+                except json.JSONDecodeError:
+                    if end_of_file:
+                        raise
+                    more_data()
+
+        expect('[')
+        read_item()
+        expect(',')
+        expect('[')
+        if next_char() == ']':
+            return
+        while True:
+            yield read_item()
+            if next_char() == ']':
+                return
+            expect(',')
+
+# Property columns with only a limited number of different values. These are stored as
+# categoricals (dictionary encoded) in the Parquet output.
+CATEGORY_FIELDS = ['ENT_AUT', 'ENT_TOW_CIT_RES', 'ENT_COU_RES', 'ENT_EXC', 'ENT_TYP_PAR_ENT', 'DER_CHI_ENT_AUT']
+
+# Partition (country) for entities without ENT_COU_RES. Without a value pyarrow writes them to a
+# default partition that can not be read together with the other partitions.
+UNKNOWN_COUNTRY = 'unknown'
+
+# Function that exports the three tables as Parquet files (columnar, compressed) with proper data
+# types instead of text. Each table is partitioned (split in folders) by the country of the
+# entity (ENT_COU_RES), so one country or a few columns can be read without reading everything.
+# Example: pd.read_parquet(folder + 'properties', filters=[('ENT_COU_RES', '==', 'NL')], columns=['EntityCode', 'ENT_NAM'])
+def export_parquet(PIR_entities, Prop_Entities, Serv_Entities, folder):
+    if pyarrow is None:
+        logger.debug('The pyarrow package is not installed. The Parquet files are not created.')
+        return
+    countries = Prop_Entities[['EntityCode', 'ENT_COU_RES']].copy()
+    countries['ENT_COU_RES'] = countries['ENT_COU_RES'].replace('', None).fillna(UNKNOWN_COUNTRY)
+
+    entities = PIR_entities.merge(countries, on='EntityCode', how='left')
+    entities['ENT_COU_RES'] = entities['ENT_COU_RES'].fillna(UNKNOWN_COUNTRY)
+    versions = pd.to_numeric(entities['EBA_Entity_Version'], errors='coerce')
+    if versions.notna().all():
+        entities['EBA_Entity_Version'] = versions.astype('int64')
+    entities = entities.astype({'ID': 'category', 'EntityType': 'category', 'EntityCode': 'string'})
+
+    properties = Prop_Entities.astype('string')
+    properties['ENT_COU_RES'] = countries['ENT_COU_RES'].astype('string')
+    for field in CATEGORY_FIELDS:
+        if field in properties.columns and field != 'ENT_COU_RES':
+            properties[field] = properties[field].astype('category')
+
+    services = Serv_Entities.merge(countries, on='EntityCode', how='left')
+    services['ENT_COU_RES'] = services['ENT_COU_RES'].fillna(UNKNOWN_COUNTRY)
+    services = services.astype({'EntityCode': 'category', 'EntityCountryServCode': 'category', 'EntityServType': 'category'})
+
+    for name, table in (('entities', entities), ('properties', properties), ('services', services)):
+        table.to_parquet(folder + name, engine='pyarrow', compression='zstd', partition_cols=['ENT_COU_RES'], index=False,
+                         existing_data_behavior='delete_matching')
+        logger.debug('Parquet files created in: ' + folder + name)
+
+# Function that finds the EntityCode of a parent entity. ENT_COD_PAR_ENT can be the EntityCode
+# of the parent or the national code of the parent. In the last case the EntityCode is the
+# code of the authority (the part before the !) of the child entity and the national code.
+def parent_entitycode(entitycode, parentcode, entitycodes):
+    if parentcode in entitycodes:
+        return parentcode
+    owner_code = entitycode.split('!')[0] + '!' + parentcode
+    if owner_code in entitycodes:
+        return owner_code
+    return parentcode
+
+# Function that builds the parent / child hierarchy of the entities (agents and branches of a
+# payment institution) from ENT_COD_PAR_ENT. Returns a dictionary with:
+# parents: the direct parent(s) of each entity, children: the direct children of each entity,
+# descendants: all entities below an entity (with the depth), roots: the top parent(s) of each entity.
+# This way "all agents under institution X" and "root parent of agent Y" are simple lookups.
+def build_hierarchy(Prop_Entities):
+    entitycodes = set(Prop_Entities['EntityCode'])
+    parents = {}
+    children = {}
+    for entitycode, value in Prop_Entities[['EntityCode', 'ENT_COD_PAR_ENT']].dropna().itertuples(index=False):
+        for parentcode in value.split(MULTI_VALUE_SEPARATOR):
+            parentcode = parent_entitycode(entitycode, parentcode, entitycodes)
+            if parentcode != entitycode:
+                parents.setdefault(entitycode, []).append(parentcode)
+                children.setdefault(parentcode, []).append(entitycode)
+
+    # All ancestors of an entity with the depth (1 = direct parent). Results are remembered, so
+    # each part of the hierarchy is only walked once. A loop in the data is stopped.
+    ancestors_found = {}
+    def ancestors(entitycode, path=()):
+        if entitycode in ancestors_found:
+            return ancestors_found[entitycode]
+        found = {}
+        for parentcode in parents.get(entitycode, []):
+            if parentcode in path or parentcode == entitycode:
+                logger.debug('Loop in the parent / child hierarchy at: ' + entitycode)
+                continue
+            found.setdefault(parentcode, 1)
+            for ancestor, depth in ancestors(parentcode, path + (entitycode,)).items():
+                if ancestor != entitycode and (ancestor not in found or depth + 1 < found[ancestor]):
+                    found[ancestor] = depth + 1
+        ancestors_found[entitycode] = found
+        return found
+
+    descendants = {}
+    roots = {}
+    for entitycode in parents:
+        for ancestor, depth in ancestors(entitycode).items():
+            descendants.setdefault(ancestor, []).append((entitycode, depth))
+            if ancestor not in parents:
+                roots.setdefault(entitycode, []).append(ancestor)
+    return {'parents': parents, 'children': children, 'descendants': descendants, 'roots': roots}
+
+# Function that turns the hierarchy in a transitive closure table: one row for each entity and
+# each entity above it (Ancestor), with the number of levels in between (Depth) and whether the
+# ancestor is a top parent (Root).
+def hierarchy_table(hierarchy):
+    rows = [(ancestor, descendant, depth, ancestor not in hierarchy['parents'])
+            for ancestor, found in hierarchy['descendants'].items() for descendant, depth in found]
+    return pd.DataFrame(rows, columns=['Ancestor', 'Descendant', 'Depth', 'Root'])
+
+# Function that gives all entities (agents, branches) under an entity, at any level
+def entities_under(hierarchy, entitycode):
+    return [descendant for descendant, depth in hierarchy['descendants'].get(entitycode, [])]
+
+# Function that gives the top parent(s) of an entity. An entity without parent is its own root.
+def root_parents(hierarchy, entitycode):
+    return hierarchy['roots'].get(entitycode, [entitycode])
+
+# Name of the query database in the output folder. It always holds the latest processed download.
+QUERY_DATABASE = 'EBA_PIR_register.sqlite'
+
+# Function that loads the three tables in a SQLite database (file) with indexes on the fields that
+# are used for lookups. ENT_AUT can have more than one value, so it also gets its own table
+# (authorities) with one row per EntityCode and authority. The parent / child hierarchy
+# (transitive closure table) is added as the table hierarchy.
+def export_sqlite(PIR_entities, Prop_Entities, Serv_Entities, Hierarchy, dbfile):
+    if os.path.exists(dbfile):
+        os.remove(dbfile)
+    authorities = Prop_Entities[['EntityCode', 'ENT_AUT']].dropna()
+    authorities = authorities.assign(ENT_AUT=authorities['ENT_AUT'].str.split(MULTI_VALUE_SEPARATOR, regex=False)).explode('ENT_AUT')
+    with sqlite3.connect(dbfile) as connection:
+        PIR_entities.to_sql('entities', connection, index=False, chunksize=50000)
+        Prop_Entities.to_sql('properties', connection, index=False, chunksize=50000)
+        Serv_Entities.to_sql('services', connection, index=False, chunksize=50000)
+        authorities.to_sql('authorities', connection, index=False, chunksize=50000)
+        Hierarchy.to_sql('hierarchy', connection, index=False, chunksize=50000)
+        connection.executescript("""
+            CREATE INDEX idx_entities_code ON entities (EntityCode);
+            CREATE INDEX idx_properties_code ON properties (EntityCode);
+            CREATE INDEX idx_properties_ref ON properties (ENT_NAT_REF_COD);
+            CREATE INDEX idx_properties_country ON properties (ENT_COU_RES);
+            CREATE INDEX idx_authorities_aut ON authorities (ENT_AUT);
+            CREATE INDEX idx_services_code ON services (EntityCode);
+            CREATE INDEX idx_services_type ON services (EntityServType, EntityCountryServCode);
+            CREATE INDEX idx_hierarchy_ancestor ON hierarchy (Ancestor);
+            CREATE INDEX idx_hierarchy_descendant ON hierarchy (Descendant);
+        """)
+    connection.close()
+    logger.debug('Query database created: ' + dbfile)
+
+# The lookups that can be done in the query database and the query used for each of them.
+# The results are the properties of the entities that were found.
+QUERY_LOOKUPS = {
+    'EntityCode': 'SELECT * FROM properties WHERE EntityCode = ?',
+    'ENT_NAT_REF_COD': 'SELECT * FROM properties WHERE ENT_NAT_REF_COD = ?',
+    'ENT_COU_RES': 'SELECT * FROM properties WHERE ENT_COU_RES = ?',
+    'ENT_AUT': 'SELECT p.* FROM authorities a JOIN properties p ON p.EntityCode = a.EntityCode WHERE a.ENT_AUT = ?',
+    'Agents_of_EntityCode': 'SELECT p.*, h.Depth FROM hierarchy h JOIN properties p ON p.EntityCode = h.Descendant WHERE h.Ancestor = ?',
+    'Root_parent_of_EntityCode': 'SELECT p.* FROM hierarchy h JOIN properties p ON p.EntityCode = h.Ancestor WHERE h.Descendant = ? AND h.Root = 1',
+}
+
+# Function that looks up entities in the query database on one of the fields in QUERY_LOOKUPS
+def query_register(dbfile, field, value):
+    if field not in QUERY_LOOKUPS:
+        raise ValueError(f'Lookup not possible on field: {field}')
+    with sqlite3.connect(dbfile) as connection:
+        result = pd.read_sql_query(QUERY_LOOKUPS[field], connection, params=(value,))
+    connection.close()
+    return result
+
+# Function that looks up the entities that provide a service (for example PS_03), optionally in one country
+def query_service(dbfile, service, country=None):
+    query = 'SELECT p.*, s.EntityCountryServCode FROM services s JOIN properties p ON p.EntityCode = s.EntityCode WHERE s.EntityServType = ?'
+    params = [service]
+    if country:
+        query += ' AND s.EntityCountryServCode = ?'
+        params.append(country)
+    with sqlite3.connect(dbfile) as connection:
+        result = pd.read_sql_query(query, connection, params=params)
+    connection.close()
+    return result
+
+# Name of the name search index in the output folder (next to the csv files)
+NAME_INDEX = 'EBA_PIR_name_index.json.gz'
+
+# Function that makes names comparable: no accents, lower case and only letters and digits
+def normalize_name(name):
+    name = unicodedata.normalize('NFKD', str(name))
+    name = ''.join(character for character in name if not unicodedata.combining(character))
+    return ' '.join(''.join(character if character.isalnum() else ' ' for character in name.lower()).split())
+
+# Function that splits a (normalized) name in trigrams: all parts of three characters
+def name_trigrams(name):
+    name = '  ' + name + ' '
+    return {name[i:i + 3] for i in range(len(name) - 2)}
+
+# Function that builds a trigram index over the names (ENT_NAM) and commercial names (ENT_NAM_COM)
+# of the entities. For each trigram it lists the names that contain it, so a search only has
+# to look at the names that share trigrams with the search text.
+def build_name_index(Prop_Entities):
+    codes = []
+    names = []
+    for column in ('ENT_NAM', 'ENT_NAM_COM'):
+        for entitycode, value in Prop_Entities[['EntityCode', column]].dropna().itertuples(index=False):
+            for name in value.split(MULTI_VALUE_SEPARATOR):
+                codes.append(entitycode)
+                names.append(name)
+    grams = {}
+    sizes = []
+    for nameid, name in enumerate(names):
+        name_grams = name_trigrams(normalize_name(name))
+        sizes.append(len(name_grams))
+        for gram in name_grams:
+            grams.setdefault(gram, []).append(nameid)
+    return {'codes': codes, 'names': names, 'sizes': sizes, 'grams': grams}
+
+# Function that saves the name index as a (compressed) Json file
+def save_name_index(indexfile, index):
+    with gzip.open(indexfile, 'wt', encoding='utf-8') as f:
+        json.dump(index, f)
+
+# Function that reads a saved name index. The lists are turned into numpy arrays for fast counting.
+def load_name_index(indexfile):
+    with gzip.open(indexfile, 'rt', encoding='utf-8') as f:
+        index = json.load(f)
+    index['sizes'] = np.array(index['sizes'], dtype=np.int32)
+    index['grams'] = {gram: np.array(nameids, dtype=np.int32) for gram, nameids in index['grams'].items()}
+    return index
+
+# Function that finds the names that look most like the search text. The score is the share of
+# trigrams that the name and the search text have in common (Dice coefficient, 1 = the same).
+# Returns a table with the best matches (one row per entity), best match first.
+def search_names(index, text, limit=10):
+    text_grams = name_trigrams(normalize_name(text))
+    postings = [index['grams'][gram] for gram in text_grams if gram in index['grams']]
+    if not postings:
+        return pd.DataFrame(columns=['EntityCode', 'Name', 'Score'])
+    common = np.bincount(np.concatenate(postings), minlength=len(index['sizes']))
+    scores = 2 * common / (index['sizes'] + len(text_grams))
+    best = np.argsort(-scores, kind='stable')[:limit * 5]
+    best = best[scores[best] > 0]
+    result = pd.DataFrame({'EntityCode': [index['codes'][nameid] for nameid in best],
+                           'Name': [index['names'][nameid] for nameid in best],
+                           'Score': scores[best].round(3)})
+    return result.drop_duplicates(subset=['EntityCode']).head(limit).reset_index(drop=True)
+
+# Function that asks for lookups in the query database and shows the results on screen
+def lookup_register():
+    pathi = input('Provide the folder of the processed register (the folder that has the output folder). Example folder name: c:\\temp\\ \n')
+    dbfile = pathi + 'output\\' + QUERY_DATABASE
+    indexfile = pathi + 'output\\' + NAME_INDEX
+    bitsetfile = pathi + 'output\\' + SERVICES_BITSET
+    fields = []
+    if os.path.exists(dbfile):
+        fields += list(QUERY_LOOKUPS) + ['Service']
+    # Without the query database the services are looked up in the services bitset
+    bitset = None
+    if not os.path.exists(dbfile) and os.path.exists(bitsetfile):
+        bitset, service_types = load_services_bitset(bitsetfile)
+        fields.append('Service')
+    name_index = None
+    if os.path.exists(indexfile):
+        name_index = load_name_index(indexfile)
+        fields.append('Name')
+    if not fields:
+        print('No query database, services bitset or name index found in: ' + pathi + 'output\nProcess a register download first.')
+        return
+    while True:
+        field = input(f'\nWhat do you want to look up? Choose from: {", ".join(fields)}\nEnter q if you want to stop.\n')
+        if field == 'q':
+            break
+        if field not in fields:
+            print('Wrong choice. Please try again.')
+            continue
+        if field == 'Name':
+            result = search_names(name_index, input('Provide (part of) the name of the entity:\n'))
+        elif field == 'Service':
+            service = input('Provide the service code. Example: PS_03\n')
+            country = input('Provide the country code (or press Enter for all countries). Example: DE\n')
+            if bitset is not None:
+                result = entities_with_service(bitset, service_types, service, country.strip() or None)
+            else:
+                result = query_service(dbfile, service, country.strip() or None)
+        else:
+            result = query_register(dbfile, field, input(f'Provide the {field} value:\n'))
+        print(f'\nNumber of entities found: {result.shape[0]}\n', result.head(50))
+
+# Function that processes a full register download into the three tables (csv files)
+def process_register():
     # Step 1 Read Json files
     # Establish location and files with data. Put the filenames in a table
     # and add the date in the file name as data for a column
@@ -40,153 +650,33 @@ def main():
     filename = input('\nNow provide the Json filename.\n')
     namefile = pathi + filename
     logger.debug(f'Folder & Json file name provided: ' + namefile)
+    cores = os.cpu_count() or 1
+    processes = input(f'\nHow many processes (processor cores) should be used? This computer has {cores}.\nPress Enter to use all of them.\n')
+    processes = int(processes) if processes.strip() else cores
+    logger.debug(f'Number of processes used: {processes}')
+    parquet = input('\nDo you also want the tables as Parquet files, split by country (yes/no)?\n')
+    database = input('\nDo you also want to load the tables in the query database for fast lookups (yes/no)?\n')
 
     # Step 2 Generate folder for the output data
     Path(pathi + 'output').mkdir(parents=True, exist_ok=True)
 
-    # Step 3 Create ean empty data frame for the Payment entities
-    PIR_entities = pd.DataFrame()
-
-    # This step is necessary as the download usually is a list with as
-    # the first item a copyright notice (etc.) and the data is in the second (list) item.
-    f = open(f''+namefile, 'rb')
-    data = json.load(f)
-    datatwo = data[1]
-
-    # Iterating through the json list to get specific items
-    # First put them in item lists and then create a table by combining them
+    # Step 3 Read the entities from the Json file one at a time and extract the three tables.
+    # The download usually is a list with as the first item a copyright notice (etc.)
+    # and the data is in the second (list) item.
     # The EBA register has multilevels and requires separate parts to be processed
-    # separately. At a later stage these tables (csv) can be combined if needed.
-
+    # separately. Each entity is read once and used for all three tables.
+    # At a later stage these tables (csv) can be combined if needed.
+    #
     # Step 4 EBA Register base level part (1).
-    id_list = []
-    entitycode = []
-    entitytype = []
-    eba_entity_version = []
-    for l1 in datatwo:
-        logger.debug('Processing EBA entity main data: ' + l1['EntityCode'])
-        id_list.append(l1['CA_OwnerID'])
-        entitycode.append(l1['EntityCode'])
-        entitytype.append(l1['EntityType'])
-        eba_entity_version.append(l1['__EBA_EntityVersion'])
-    id_data = {'ID': id_list}
-    test_list = pd.DataFrame(id_data)
-    test_list['EntityCode'] = entitycode
-    test_list['EntityType'] = entitytype
-    test_list['EBA_Entity_Version'] = eba_entity_version
-    PIR_entities = pd.concat([PIR_entities, test_list], ignore_index=True)
-
-    # Export part 1 result as a CSV file with the date of the Python run
-    PIR_entities.to_csv(f''+pathi+'output\EBA_PIR_list_1_Entities_'+runday+'.csv', encoding='utf-8')
-
     # Step 5 Get the properties from the EBA Register for each entity.
     # This level has National property level data as reported by nations's main authority.
-    # First create a number of lists based on the maximum nr. of expected properties (14)
-    # Create a DataFrame / table for the properties
-    Prop_Entities = pd.DataFrame()
-
-    # Convert list of entity properties (list of dictionaries) to Dataframe/table
-    # This DataFrame / table will have separate rows for each characteristic and one cell
-    # that actually has the property data.
-    for l1 in datatwo:
-        logger.debug('Processing EBA entity properties: ' + l1['EntityCode'])
-        props = pd.DataFrame.from_records(l1['Properties'])
-        props['EntityCode'] = l1['EntityCode']
-        Prop_Entities = pd.concat([Prop_Entities, props], ignore_index=True)
-
-    # Use the generated Dataframe to split & clean and merge the data as it is
-    # inefficient due to empty cells as each property gets it's own row
-    # The dataframe should have 14 columns with column 8 being: EBA_EntityVersion
-    # Fields: ENT_AUT, ENT_NAT_REF_COD, ENT_NAM, ENT_ADD, ENT_TOW_CIT_RES, ENT_POS_COD,
-    # ENT_COU_RES, EBA_Entity_Version, ENT_NAM_COM, ENT_EXC, ENT_DES_ACT_EXC_SCP,
+    # Convert list of entity properties (list of dictionaries) to a Dataframe/table with one
+    # row per entity (EntityCode) and one column per property (by name). Fields:
+    # ENT_AUT, ENT_NAT_REF_COD, ENT_NAM, ENT_ADD, ENT_TOW_CIT_RES, ENT_POS_COD,
+    # ENT_COU_RES, EntityCode, ENT_NAM_COM, ENT_EXC, ENT_DES_ACT_EXC_SCP,
     # ENT_TYP_PAR_ENT, ENT_COD_PAR_ENT, DER_CHI_ENT_AUT
+    # Properties with more than one value are combined in one cell (see MULTI_VALUE_SEPARATOR).
     #
-    # WARNING: The number of fields may depend on the size of the download as this depends
-    # on what data is included in the Json File! I have based it on the full register
-    # download file. First make subsets for each property and remove cells with no data.
-    Prop1 = Prop_Entities.iloc[:, [0, 7]].copy()
-    Prop1.dropna(subset=['ENT_AUT'], inplace=True)
-    # List type ENT-AUT needs to be converted str for the merge to succeed
-    Prop1['ENT_AUT'] = Prop1["ENT_AUT"].map(str)
-
-    Prop2 = Prop_Entities.iloc[:, [1, 7]].copy()
-    Prop2.dropna(subset=['ENT_NAT_REF_COD'], inplace=True)
-    Prop3 = Prop_Entities.iloc[:, [2, 7]].copy()
-    Prop3.dropna(subset=['ENT_NAM'], inplace=True)
-    Prop4 = Prop_Entities.iloc[:, [3, 7]].copy()
-    Prop4.dropna(subset=['ENT_ADD'], inplace=True)
-    Prop5 = Prop_Entities.iloc[:, [4, 7]].copy()
-    Prop5.dropna(subset=['ENT_TOW_CIT_RES'], inplace=True)
-    Prop6 = Prop_Entities.iloc[:, [5, 7]].copy()
-    Prop6.dropna(subset=['ENT_POS_COD'], inplace=True)
-    Prop7 = Prop_Entities.iloc[:, [6, 7]].copy()
-    Prop7.dropna(subset=['ENT_COU_RES'], inplace=True)
-    Prop8 = Prop_Entities.iloc[:, [7, 8]].copy()
-    Prop8.dropna(subset=['ENT_NAM_COM'], inplace=True)
-    Prop9 = Prop_Entities.iloc[:, [7, 9]].copy()
-    Prop9.dropna(subset=['ENT_EXC'], inplace=True)
-    Prop10 = Prop_Entities.iloc[:, [7, 10]].copy()
-    Prop10.dropna(subset=['ENT_DES_ACT_EXC_SCP'], inplace=True)
-    Prop11 = Prop_Entities.iloc[:, [7, 11]].copy()
-    Prop11.dropna(subset=['ENT_TYP_PAR_ENT'], inplace=True)
-    Prop12 = Prop_Entities.iloc[:, [7, 12]].copy()
-    Prop12.dropna(subset=['ENT_COD_PAR_ENT'], inplace=True)
-    Prop13 = Prop_Entities.iloc[:, [7, 13]].copy()
-    Prop13.dropna(subset=['DER_CHI_ENT_AUT'], inplace=True)
-
-    # Now merge the subsets into a new table/Dataframe
-    Merge1 = pd.merge(Prop1, Prop2, on=['EntityCode'], how='outer')
-    Merge1.drop_duplicates(subset=['ENT_AUT', 'EntityCode', 'ENT_NAT_REF_COD'], keep='first', ignore_index=True, inplace=True)
-    Merge2 = pd.merge(Prop3, Merge1, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge2 = Merge2.applymap(str)
-    Merge2.drop_duplicates(subset=['ENT_AUT', 'EntityCode', 'ENT_NAT_REF_COD', 'ENT_NAM'], keep='first', ignore_index=True, inplace=True)
-    Merge3 = pd.merge(Prop4, Merge2, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge3 = Merge3.applymap(str)
-    Merge3.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge4 = pd.merge(Prop5, Merge3, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge4 = Merge4.applymap(str)
-    Merge4.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge5 = pd.merge(Prop6, Merge4, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge5 = Merge5.applymap(str)
-    Merge5.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge6 = pd.merge(Prop7, Merge5, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge6 = Merge6.applymap(str)
-    Merge6.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge7 = pd.merge(Prop8, Merge6, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge7 = Merge7.applymap(str)
-    Merge7.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge8 = pd.merge(Prop9, Merge7, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge8 = Merge8.applymap(str)
-    Merge8.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge9 = pd.merge(Prop10, Merge8, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge9 = Merge9.applymap(str)
-    Merge9.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge10 = pd.merge(Prop11, Merge9, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge10 = Merge10.applymap(str)
-    Merge10.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge11 = pd.merge(Prop12, Merge10, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge11 = Merge11.applymap(str)
-    Merge11.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-    Merge12 = pd.merge(Prop13, Merge11, on=['EntityCode'], how='outer')
-    # To avoid problems with columns that keep being interpreted as lists:
-    Merge12 = Merge12.applymap(str)
-    Merge12.drop_duplicates(keep='first', ignore_index=True, inplace=True)
-
-    # Order the fields as they were in the original Json download file
-    Merge12 = Merge12[['ENT_AUT', 'ENT_NAT_REF_COD', 'ENT_NAM', 'ENT_ADD', 'ENT_TOW_CIT_RES', 'ENT_POS_COD', 'ENT_COU_RES',	'EntityCode', 'ENT_NAM_COM', 'ENT_EXC', 'ENT_DES_ACT_EXC_SCP', 'ENT_TYP_PAR_ENT', 'ENT_COD_PAR_ENT', 'DER_CHI_ENT_AUT']]
-    # Download the properties as a separate table
-    Merge12.to_csv(f'' + pathi + 'output\EBA_PIR_list_2_EntityProperties_' + runday + '.csv', encoding='utf-8')
-
     # Step 6 Get the services for each entity in the register. These will only
     # be there for active entities (according to the information at the time of
     # the download. Country Codes are 2 digit ISO 3166 international standard codes.
@@ -195,33 +685,122 @@ def main():
     # The services are based on Annex I to PSD2 and issuing electronic money under EMD2.
     # See also: https://en.wikipedia.org/wiki/Payment_Services_Directive
     # And: https://en.wikipedia.org/wiki/E-Money_Directive
-    #
-    Serv_Entities = pd.DataFrame()
-    entitycode_s = []
-    entity_sco = []
-    entity_sty = []
-    for l1 in datatwo:
-        entity_length = len(l1)
-        if entity_length < 6:
-            pass
-        else:
-            servlist = l1['Services']
-            logger.debug('Processing EBA entity services')
-            for dataitem in servlist:
-                for country in dataitem:
-                    service_codes = dataitem[country]
-                    entitycode_s.extend([l1['EntityCode']]*len(service_codes))
-                    entity_sco.extend([country]*len(service_codes))
-                    entity_sty.extend(service_codes)
     # Result for each service by nation should be a row of three items:
     # Entity Code, CountryCode, ServiceCode
-    id_data_s = {'EntityCode': entitycode_s}
-    test_lists = pd.DataFrame(id_data_s)
-    test_lists['EntityCountryServCode'] = entity_sco
-    test_lists['EntityServType'] = entity_sty
-    Serv_Entities = pd.concat([Serv_Entities, test_lists], ignore_index=True)
+    # The entities are processed in shards that can be divided over more processor cores.
+    # If there is a state file of a previous run in the output folder, only the new entities and
+    # entities with a new __EBA_EntityVersion are extracted. The others are taken from the state file.
+    statefile = pathi + 'output\\EBA_PIR_state.json.gz'
+    state = load_state(statefile)
+    logger.debug(f'Entities in the state file of the previous run: {len(state)}')
+    PIR_entities, Prop_Entities, Serv_Entities, state = extract_register(iter_register_entities(namefile), processes, state)
+    save_state(statefile, state)
+    logger.debug(f'Memory used by the services table: {Serv_Entities.memory_usage(deep=True).sum() / 1e6:.1f} MB')
+
+    # Export the results as CSV files with the date of the Python run
+    PIR_entities.to_csv(f''+pathi+'output\EBA_PIR_list_1_Entities_'+runday+'.csv', encoding='utf-8')
+    Prop_Entities.to_csv(f'' + pathi + 'output\EBA_PIR_list_2_EntityProperties_' + runday + '.csv', encoding='utf-8')
     Serv_Entities.to_csv(f'' + pathi + 'output\EBA_PIR_list_3_EntityServices_' + runday + '.csv', encoding='utf-8')
 
+    # Optional export as Parquet files (partitioned by country)
+    if parquet == 'yes':
+        export_parquet(PIR_entities, Prop_Entities, Serv_Entities, pathi + 'output\\EBA_PIR_parquet_' + runday + '\\')
+
+    # Parent / child hierarchy of agents and branches as a transitive closure table
+    Hierarchy = hierarchy_table(build_hierarchy(Prop_Entities))
+    Hierarchy.to_csv(f'' + pathi + 'output\\EBA_PIR_list_4_EntityHierarchy_' + runday + '.csv', encoding='utf-8')
+
+    # Services in bitset form (one number per entity and country) for Service lookups without the query database
+    save_services_bitset(pathi + 'output\\' + SERVICES_BITSET, *services_bitset(Serv_Entities))
+
+    # Name search index (trigrams) for finding entities by approximate name
+    save_name_index(pathi + 'output\\' + NAME_INDEX, build_name_index(Prop_Entities))
+
+    # Optional query database (SQLite) for lookups on the latest download
+    if database == 'yes':
+        export_sqlite(PIR_entities, Prop_Entities, Serv_Entities, Hierarchy, pathi + 'output\\' + QUERY_DATABASE)
+
+# Function that collects what is needed to compare one entity: the version, the properties
+# (without EntityCode) and the services as a set of (CountryCode, ServiceCode)
+def entity_snapshot(l1):
+    props = entity_properties(l1)
+    del props['EntityCode']
+    services = {(country, service_code) for entitycode_s, country, service_code in entity_services(l1)}
+    return l1['__EBA_EntityVersion'], props, services
+
+# Function that compares two register downloads (for example 2021 and 2023). Only the old download
+# is kept in memory as a dictionary keyed on EntityCode. The new download is streamed and every
+# entity is looked up in that dictionary. Whatever is left in the dictionary has been removed.
+# Returns three tables: the added / removed / modified entities, the changed property values of
+# modified entities and the services that were added or withdrawn per country.
+def diff_registers(oldfile, newfile):
+    old = {l1['EntityCode']: entity_snapshot(l1) for l1 in iter_register_entities(oldfile)}
+    logger.debug(f'Entities in the old download: {len(old)}')
+    entity_changes = []
+    property_changes = []
+    service_changes = []
+
+    def services_changed(entitycode, services, change):
+        for country, service_code in sorted(services):
+            service_changes.append((entitycode, country, service_code, change))
+
+    for l1 in iter_register_entities(newfile):
+        entitycode = l1['EntityCode']
+        version, props, services = entity_snapshot(l1)
+        previous = old.pop(entitycode, None)
+        if previous is None:
+            entity_changes.append((entitycode, 'added', None, version))
+            services_changed(entitycode, services, 'added')
+            continue
+        old_version, old_props, old_services = previous
+        if old_version == version and old_props == props and old_services == services:
+            continue
+        entity_changes.append((entitycode, 'modified', old_version, version))
+        for field in dict.fromkeys([*old_props, *props]):
+            if old_props.get(field) != props.get(field):
+                property_changes.append((entitycode, field, old_props.get(field), props.get(field)))
+        services_changed(entitycode, services - old_services, 'added')
+        services_changed(entitycode, old_services - services, 'withdrawn')
+
+    for entitycode, (old_version, old_props, old_services) in old.items():
+        entity_changes.append((entitycode, 'removed', old_version, None))
+        services_changed(entitycode, old_services, 'withdrawn')
+
+    return (pd.DataFrame(entity_changes, columns=['EntityCode', 'Change', 'Old_EBA_Entity_Version', 'New_EBA_Entity_Version']),
+            pd.DataFrame(property_changes, columns=['EntityCode', 'Property', 'Old_value', 'New_value']),
+            pd.DataFrame(service_changes, columns=['EntityCode', 'EntityCountryServCode', 'EntityServType', 'Change']))
+
+# Function that asks for two register downloads and exports what changed between them
+def compare_registers():
+    pathi = input('Provide the folder of the two Json files. Example folder name: c:\\temp\\ \n')
+    oldname = input('\nNow provide the Json filename of the old download.\n')
+    newname = input('\nNow provide the Json filename of the new download.\n')
+    logger.debug(f'Comparing register downloads: ' + pathi + oldname + ' & ' + pathi + newname)
+    Path(pathi + 'output').mkdir(parents=True, exist_ok=True)
+
+    Entity_changes, Property_changes, Service_changes = diff_registers(pathi + oldname, pathi + newname)
+    counts = Entity_changes['Change'].value_counts()
+    logger.debug(f"Entities added: {counts.get('added', 0)}, removed: {counts.get('removed', 0)}, modified: {counts.get('modified', 0)}")
+
+    Entity_changes.to_csv(f'' + pathi + 'output\\EBA_PIR_changes_1_Entities_' + runday + '.csv', encoding='utf-8')
+    Property_changes.to_csv(f'' + pathi + 'output\\EBA_PIR_changes_2_EntityProperties_' + runday + '.csv', encoding='utf-8')
+    Service_changes.to_csv(f'' + pathi + 'output\\EBA_PIR_changes_3_EntityServices_' + runday + '.csv', encoding='utf-8')
+
+logger.add(r'U:\Werk\Data Management\Python\\Files\output\EBA_Process_'+runday+'.log', backtrace=True, diagnose=True, rotation="10 MB", retention="12 months")
+@logger.catch()
+
+def main():
+    # What does the user want to do?
+    choice = ''
+    while choice not in ('1', '2', '3'):
+        choice = input('Do you want to process a register download (1), compare two downloads (2)\nor look up entities in the processed register (3)?\nPlease enter your choice (1, 2 or 3):')
+    if choice == '1':
+        process_register()
+    elif choice == '2':
+        compare_registers()
+    else:
+        lookup_register()
+
     # Logging of script run:
     end = str(datetime.now())
     logger.debug('Processing started at: ' + now)
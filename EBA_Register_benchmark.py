@@ -0,0 +1,133 @@
+# This script measures how long each stage of EBA_Register.py takes and how much memory it
+# needs, using synthetic register files (see EBA_Register_generator.py) of different sizes.
+# This makes it possible to see how the processing time grows with the size of the register
+# and to find slow changes (regressions) without a real download.
+# The stages: loading (reading the Json file), step 4 (entities), step 5 (properties pivot),
+# step 6 (services), the single pass extraction of all three tables and the CSV export.
+#
+# 2026-10-18
+# Script version 1.0
+
+import os
+import pandas as pd
+from loguru import logger
+import time
+import tracemalloc
+from datetime import datetime
+from pathlib import Path
+import EBA_Register as eba
+from EBA_Register_generator import generate_register
+
+# Show all data in screen
+pd.set_option("display.max.columns", None)
+# Create date variable for filenames etc.
+runday = str(datetime.today().date())
+
+# Create a date + time for file logging
+now = str(datetime.now())
+nowt = time.time()
+
+# Function that runs one stage and measures the time (seconds) and the highest memory use (MB).
+# Memory is measured with tracemalloc in a second run, as tracemalloc makes Python a lot slower.
+# tracemalloc only sees the memory of this (main) process, not of the worker processes.
+def measure(stage, function, *arguments):
+    start = time.perf_counter()
+    result = function(*arguments)
+    seconds = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = function(*arguments)
+    peak = tracemalloc.get_traced_memory()[1] / 1e6
+    tracemalloc.stop()
+    logger.debug(f'{stage}: {seconds:.2f} seconds, {peak:.1f} MB')
+    return result, round(seconds, 3), round(peak, 1)
+
+# Stage functions. Steps 4, 5 and 6 each get the entities in memory, so they are measured
+# separately from reading the Json file.
+def stage_load(namefile):
+    return list(eba.iter_register_entities(namefile))
+
+def stage_entities(entities):
+    return pd.DataFrame([eba.entity_base(l1) for l1 in entities])
+
+def stage_properties(entities):
+    tables = eba.new_register_tables()
+    for l1 in entities:
+        eba.append_row(tables['properties'], eba.entity_properties(l1))
+    return pd.DataFrame(tables['properties'])
+
+def stage_services(entities):
+    tables = eba.new_register_tables()
+    for l1 in entities:
+        for service in eba.entity_services(l1):
+            for column, value in zip(eba.SERVICE_COLUMNS, service):
+                eba.append_code(tables['services'][column], value)
+    return eba.build_register_tables(tables)[2]
+
+def stage_extract(namefile, processes):
+    return eba.extract_register(eba.iter_register_entities(namefile), processes)
+
+def stage_export(tables, folder):
+    for name, table in zip(('entities', 'properties', 'services'), tables):
+        table.to_csv(folder + f'EBA_benchmark_{name}.csv', encoding='utf-8')
+
+# Function that runs all stages for one register file and returns a row per stage
+def benchmark_register(namefile, folder, processes):
+    results = []
+    entities, seconds, peak = measure('Load', stage_load, namefile)
+    results.append(('Load', seconds, peak))
+    for stage, function in (('Step 4 entities', stage_entities), ('Step 5 properties', stage_properties),
+                            ('Step 6 services', stage_services)):
+        results.append((stage, *measure(stage, function, entities)[1:]))
+    size = len(entities)
+    del entities
+    tables, seconds, peak = measure('Extract single pass (1 process)', stage_extract, namefile, 1)
+    results.append(('Extract single pass (1 process)', seconds, peak))
+    if processes > 1:
+        stage = f'Extract single pass ({processes} processes)'
+        results.append((stage, *measure(stage, stage_extract, namefile, processes)[1:]))
+    results.append(('CSV export', *measure('CSV export', stage_export, tables[:3], folder)[1:]))
+    return [(size, stage, seconds, peak) for stage, seconds, peak in results]
+
+logger.add(r'U:\Werk\Data Management\Python\\Files\output\EBA_Benchmark_'+runday+'.log', backtrace=True, diagnose=True, rotation="10 MB", retention="12 months")
+@logger.catch()
+
+def main():
+    pathi = input('Provide the folder for the synthetic register files and the results. Example folder name: c:\\temp\\ \n')
+    sizes = input('How many entities? Provide one or more numbers separated by a comma. Example: 10000,184000,258000,1000000\n')
+    cores = os.cpu_count() or 1
+    processes = input(f'How many processes (processor cores) should be used for the multi-process run? This computer has {cores}.\nPress Enter to use all of them.\n')
+    processes = int(processes) if processes.strip() else cores
+    Path(pathi + 'output').mkdir(parents=True, exist_ok=True)
+
+    # Synthetic files that already exist are used again, so the same data is measured every time
+    results = []
+    for size in sizes.split(','):
+        size = int(size.strip())
+        namefile = pathi + f'EBA_PIR_synthetic_{size}.json'
+        if not os.path.exists(namefile):
+            generate_register(namefile, size)
+        logger.debug(f'Benchmark of {namefile}')
+        results.extend(benchmark_register(namefile, pathi + 'output\\', processes))
+
+    Results = pd.DataFrame(results, columns=['Entities', 'Stage', 'Seconds', 'Peak_memory_MB'])
+    print('Benchmark result:\n', Results)
+    Results.to_csv(f'' + pathi + 'output\\EBA_benchmark_' + runday + '.csv', encoding='utf-8')
+
+    # Logging of script run:
+    end = str(datetime.now())
+    logger.debug('Processing started at: ' + now)
+    logger.debug('Processing completed at: ' + end)
+    duration_s = (round((time.time() - nowt), 2))
+    if duration_s > 3600:
+        duration = str(duration_s / 3600)
+        logger.debug('Search took: ' + duration + ' hours.')
+    elif duration_s > 60:
+        duration = str(duration_s / 60)
+        logger.debug('Search took: ' + duration + ' minutes.')
+    else:
+        duration = str(duration_s)
+        logger.debug('Search took: ' + duration + ' seconds.')
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,132 @@
+# This script creates synthetic (made up) Payment Institutions Register data in the same
+# format as the full register download (json) from the European Banking Association:
+# https://euclid.eba.europa.eu/register/pir/disclaimer
+# The files can be used to test and benchmark EBA_Register.py at any size, for example
+# 10.000, 184.000 (2021 download), 258.000 (2023 download) or 1.000.000 entities.
+#
+# 2026-10-18
+# Script version 1.0
+
+import json
+import random
+from loguru import logger
+import time
+from datetime import datetime
+from pathlib import Path
+
+# Create date variable for filenames etc.
+runday = str(datetime.today().date())
+
+# Create a date + time for file logging
+now = str(datetime.now())
+nowt = time.time()
+
+# National authorities (CA_OwnerID) with their country and a weight for how many entities they have
+AUTHORITIES = [('FR_ACPR', 'FR', 20), ('IT_BDI', 'IT', 18), ('ES_BDE', 'ES', 12), ('DE_BAFIN', 'DE', 8),
+               ('NL_DNB', 'NL', 6), ('BE_NBB', 'BE', 5), ('PT_BDP', 'PT', 5), ('PL_KNF', 'PL', 4),
+               ('AT_FMA', 'AT', 3), ('IE_CBI', 'IE', 3), ('LT_LB', 'LT', 2), ('LU_CSSF', 'LU', 2),
+               ('CZ_CNB', 'CZ', 2), ('SE_FI', 'SE', 2), ('DK_FSA', 'DK', 2), ('FI_FIN-FSA', 'FI', 1),
+               ('GR_BOG', 'GR', 1), ('RO_NBR', 'RO', 1), ('HU_MNB', 'HU', 1), ('CY_CBC', 'CY', 1),
+               ('MT_MFSA', 'MT', 1), ('EE_FI', 'EE', 1), ('LV_FCMC', 'LV', 1), ('SK_NBS', 'SK', 1)]
+
+# Entity types with a weight. Most entities in the register are agents of a payment institution.
+ENTITY_TYPES = [('PSD_AG', 70), ('PSD_PI', 6), ('PSD_EPI', 5), ('EMD_AG', 8), ('PSD_BR', 3),
+                ('EMD_EMI', 2), ('EMD_BR', 1), ('PSD_EXC', 3), ('EMD_EEMI', 2)]
+
+# Entity types that can have agents or branches (parent entities)
+PARENT_TYPES = {'PSD_PI', 'EMD_EMI'}
+
+# Services based on Annex I to PSD2 and issuing electronic money under EMD2
+PSD_SERVICES = ['PS_010', 'PS_020', 'PS_030', 'PS_040', 'PS_050', 'PS_060', 'PS_070', 'PS_080']
+EMD_SERVICES = ['ES_010', 'ES_020', 'ES_030']
+
+TOWNS = ['Paris', 'Roma', 'Madrid', 'Berlin', 'Amsterdam', 'Bruxelles', 'Lisboa', 'Warszawa', 'Wien', 'Dublin',
+         'Vilnius', 'Luxembourg', 'Praha', 'Stockholm', 'Kobenhavn', 'Helsinki', 'Athina', 'Bucuresti']
+NAME_PARTS = ['Pay', 'Money', 'Transfer', 'Euro', 'Cash', 'Express', 'Global', 'Finance', 'Services', 'Union',
+              'Direct', 'Smart', 'Digital', 'Wallet', 'Exchange', 'Market', 'Trade', 'Point', 'Shop', 'Post']
+NAME_FORMS = ['SA', 'SRL', 'GmbH', 'BV', 'Ltd', 'SL', 'AB', 'UAB', 'SpA', 'SAS', 'Oy', 'NV']
+COUNTRIES = [country for authority, country, weight in AUTHORITIES]
+
+# Function that makes a random company name
+def random_name(rnd):
+    return ' '.join(rnd.sample(NAME_PARTS, rnd.randint(1, 3))) + ' ' + rnd.choice(NAME_FORMS)
+
+# Function that makes one entity (dictionary) in the same layout as the register download.
+# Agents and branches get a parent entity (ENT_TYP_PAR_ENT / ENT_COD_PAR_ENT) of the same authority.
+def random_entity(rnd, number, parents):
+    authority, country, weight = rnd.choices(AUTHORITIES, weights=[a[2] for a in AUTHORITIES])[0]
+    entitytype = rnd.choices([t[0] for t in ENTITY_TYPES], weights=[t[1] for t in ENTITY_TYPES])[0]
+    refcode = f'{country}{number:09d}'
+    entitycode = authority + '!' + refcode
+    properties = [{'ENT_AUT': [authority]}, {'ENT_NAT_REF_COD': refcode}, {'ENT_NAM': random_name(rnd)},
+                  {'ENT_ADD': f'{rnd.randint(1, 250)} {rnd.choice(NAME_PARTS)} Street'},
+                  {'ENT_TOW_CIT_RES': rnd.choice(TOWNS)}, {'ENT_POS_COD': str(rnd.randint(1000, 99999))},
+                  {'ENT_COU_RES': country}]
+    for i in range(rnd.choices([0, 1, 2, 3], weights=[70, 20, 7, 3])[0]):
+        properties.append({'ENT_NAM_COM': random_name(rnd)})
+    if entitytype == 'PSD_EXC':
+        properties.append({'ENT_EXC': 'Art. 3(k)'})
+        properties.append({'ENT_DES_ACT_EXC_SCP': 'Limited network: ' + random_name(rnd)})
+    if entitytype in ('PSD_AG', 'EMD_AG', 'PSD_BR', 'EMD_BR') and parents.get(authority):
+        parenttype, parentcode = rnd.choice(parents[authority])
+        properties.append({'ENT_TYP_PAR_ENT': parenttype})
+        properties.append({'ENT_COD_PAR_ENT': parentcode})
+    if entitytype in PARENT_TYPES:
+        parents.setdefault(authority, []).append((entitytype, refcode))
+    if rnd.random() < 0.02:
+        properties.append({'DER_CHI_ENT_AUT': str(rnd.randint(1, 3))})
+
+    entity = {'CA_OwnerID': authority, 'EntityCode': entitycode, 'EntityType': entitytype,
+              '__EBA_EntityVersion': str(rnd.choices([1, 2, 3, 4, 5], weights=[50, 25, 12, 8, 5])[0]),
+              'Properties': properties}
+    # Only active (non agent) entities have services: in the home country and (passporting) abroad
+    if entitytype not in ('PSD_AG', 'EMD_AG') and rnd.random() < 0.8:
+        servicelist = PSD_SERVICES + (EMD_SERVICES if entitytype.startswith('EMD') else [])
+        abroad = rnd.sample(COUNTRIES, rnd.choices([0, 1, 3, 10, 23], weights=[40, 25, 15, 12, 8])[0])
+        entity['Services'] = [{servicecountry: sorted(rnd.sample(servicelist, rnd.randint(1, 6)))}
+                              for servicecountry in dict.fromkeys([country] + abroad)]
+    return entity
+
+# Function that writes a register download with the number of entities asked for. The entities are
+# written one at a time, so even very large files do not need much memory. With the same seed
+# the same file is created.
+def generate_register(namefile, entities, seed=2023):
+    rnd = random.Random(seed)
+    parents = {}
+    with open(namefile, 'w', encoding='utf-8') as f:
+        f.write('[{"Copyright": "Synthetic test data in the layout of the EBA Payment Institutions Register"},\n[')
+        for number in range(entities):
+            if number:
+                f.write(',\n')
+            f.write(json.dumps(random_entity(rnd, number, parents)))
+        f.write(']]')
+    logger.debug(f'Synthetic register created: {namefile} with {entities} entities')
+
+logger.add(r'U:\Werk\Data Management\Python\\Files\output\EBA_Generator_'+runday+'.log', backtrace=True, diagnose=True, rotation="10 MB", retention="12 months")
+@logger.catch()
+
+def main():
+    pathi = input('Provide the folder for the synthetic register file(s). Example folder name: c:\\temp\\ \n')
+    sizes = input('How many entities? Provide one or more numbers separated by a comma. Example: 10000,184000,258000,1000000\n')
+    Path(pathi).mkdir(parents=True, exist_ok=True)
+    for size in sizes.split(','):
+        size = int(size.strip())
+        generate_register(pathi + f'EBA_PIR_synthetic_{size}.json', size)
+
+    # Logging of script run:
+    end = str(datetime.now())
+    logger.debug('Processing started at: ' + now)
+    logger.debug('Processing completed at: ' + end)
+    duration_s = (round((time.time() - nowt), 2))
+    if duration_s > 3600:
+        duration = str(duration_s / 3600)
+        logger.debug('Search took: ' + duration + ' hours.')
+    elif duration_s > 60:
+        duration = str(duration_s / 60)
+        logger.debug('Search took: ' + duration + ' minutes.')
+    else:
+        duration = str(duration_s)
+        logger.debug('Search took: ' + duration + ' seconds.')
+
+if __name__ == "__main__":
+    main()
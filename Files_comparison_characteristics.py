@@ -4,7 +4,7 @@
 #
 # Mark Bruyneel
 # 2024-09-21
-# Script version 1.1
+# Script version 1.2
 
 import os
 import sys
@@ -13,6 +13,7 @@ import numpy as np
 from loguru import logger
 import time
 import hashlib
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed, wait, FIRST_COMPLETED
 from datetime import datetime, timedelta
 from pathlib import Path
 
@@ -39,7 +40,7 @@ def rdbl_time(NewTime):
     dt = datetime.fromtimestamp(NewTime)  # conver from epoch timestamp to datetime
     return datetime.strftime(dt, "%Y %b %d (%a), %H:%M:%S")
 
-# Function that calculates the MD5 Hash of a file in chunks of 4 kilobytes. Hashes are the output of a hashing algorithm
+# Function that calculates the Hash of a file. Hashes are the output of a hashing algorithm
 # like MD5 (Message Digest 5) or SHA (Secure Hash Algorithm). These algorithms essentially aim to produce a unique,
 # fixed-length string – the hash value, or “message digest” – for any given piece of data or “message”. As every file on
 # a computer is, ultimately, just data that can be represented in binary form, a hashing algorithm can take that data
@@ -47,13 +48,108 @@ def rdbl_time(NewTime):
 # the file’s hash value or message digest.
 # In this case I chose to use MD5 over SHA1. MD5 generates a 128-bit hash result and is faster.
 # SHA1 generates a 160-bit hash value and provides higher security, but it is slower.
-def calculate_md5(file_path):
-    hasher = hashlib.md5()
+# BLAKE2b is faster than MD5 on 64-bit computers and is the default now. MD5 can still be chosen
+# to compare with results of earlier versions of this script.
+# The file is read in chunks of HASH_BUFFER_SIZE bytes into the same buffer (readinto), so reading
+# the file and not Python itself determines the speed.
+HASH_ALGORITHMS = ('blake2b', 'md5')
+HASH_BUFFER_SIZE = 1024 * 1024
+
+def calculate_hash(file_path, algorithm='blake2b'):
+    hasher = hashlib.new(algorithm)
+    buffer = bytearray(HASH_BUFFER_SIZE)
+    view = memoryview(buffer)
+    with open(file_path, 'rb', buffering=0) as f:
+        while True:
+            size = f.readinto(buffer)
+            if not size:
+                break
+            hasher.update(view[:size])
+    return hasher.hexdigest()
+
+# Number of bytes at the start and at the end of a file that are used for the partial hash
+PARTIAL_SIZE = 64 * 1024
+
+# Function that calculates the Hash of the first and last PARTIAL_SIZE bytes of a file. Files that differ
+# there do not have to be read in full. For a file of up to 2 * PARTIAL_SIZE bytes this is the full hash.
+def calculate_partial_hash(file_path, file_size, algorithm='blake2b'):
+    hasher = hashlib.new(algorithm)
     with open(file_path, 'rb') as f:
-        for chunk in iter(lambda: f.read(4096), b''):
-            hasher.update(chunk)
+        hasher.update(f.read(PARTIAL_SIZE))
+        if file_size > 2 * PARTIAL_SIZE:
+            f.seek(-PARTIAL_SIZE, os.SEEK_END)
+        hasher.update(f.read())
     return hasher.hexdigest()
 
+# Function that calculates the hashes of a list of files: function(*task) for each task. Several files are
+# hashed at the same time by a pool of workers: threads (hashlib lets other threads run while it hashes a
+# chunk, so this keeps more disks or a network share busy) or, with processes, separate processes.
+# Only workers * 2 files are handed out ahead. Returns the hashes in the order of the tasks.
+def run_hashing(function, tasks, workers=1, processes=False):
+    if workers <= 1:
+        return [function(*task) for task in tasks]
+    results = [None] * len(tasks)
+    pool = ProcessPoolExecutor if processes else ThreadPoolExecutor
+    with pool(max_workers=workers) as executor:
+        running = {}
+        for tasknr, task in enumerate(tasks):
+            running[executor.submit(function, *task)] = tasknr
+            if len(running) >= workers * 2:
+                done, pending = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    results[running.pop(future)] = future.result()
+        for future in as_completed(running):
+            results[running[future]] = future.result()
+    return results
+
+# Function that gives the characteristics of the files in a folder (without the subfolders):
+# name, size, creation time, last modified time and folder. The file data is only read once per file.
+# Remark: st_ctime is creation time on Windows computers
+def file_characteristics(folder):
+    data_of_files = []
+    for entry in os.scandir(folder):
+        if entry.is_file():
+            file_stat = entry.stat()
+            data_of_files.append((entry.name, file_stat.st_size, rdbl_time(file_stat.st_ctime), rdbl_time(file_stat.st_mtime), folder))
+    return data_of_files
+
+# Function that adds the hash of the files to both tables in stages. Each stage only looks at the files
+# that can still be the same as a file in the other folder (the stage is given in the column Hash_stage):
+# Size: the size is not in the other folder, the file is not read and gets an empty hash.
+# Partial: the first and last bytes (partial hash) are not the same as those of a file in the other folder.
+# Full: the hash of the whole file. Only these hashes are compared.
+# The hash algorithm that was used is added in the column Hash_algorithm.
+# The files are hashed by workers threads (or processes, see run_hashing).
+def add_file_hashes(folder_list1, folder_list2, algorithm='blake2b', workers=1, processes=False):
+    folder_lists = (folder_list1, folder_list2)
+    for folder_list in folder_lists:
+        folder_list.insert(4, 'File_hash', '')
+        folder_list.insert(5, 'Hash_stage', 'Size')
+        folder_list.insert(6, 'Hash_algorithm', algorithm)
+
+    # Partial hash of the files with a size that is in both folders. Small files are then read in full.
+    shared_sizes = set(folder_list1['File_size']) & set(folder_list2['File_size'])
+    for folder_list in folder_lists:
+        files = folder_list[folder_list['File_size'].isin(shared_sizes)]
+        folder_list.loc[files.index, 'File_hash'] = run_hashing(calculate_partial_hash, [(folder + f, size, algorithm)
+                                                                for f, size, folder in zip(files['File_name'], files['File_size'], files['File_folder'])],
+                                                                workers, processes)
+        folder_list.loc[files.index, 'Hash_stage'] = np.where(files['File_size'] > 2 * PARTIAL_SIZE, 'Partial', 'Full')
+
+    # Full hash of the files with a size and partial hash that are in both folders
+    partial_keys = [set(zip(folder_list.loc[folder_list['Hash_stage'] == 'Partial', 'File_size'],
+                            folder_list.loc[folder_list['Hash_stage'] == 'Partial', 'File_hash'])) for folder_list in folder_lists]
+    shared_keys = partial_keys[0] & partial_keys[1]
+    for folder_list in folder_lists:
+        files = folder_list[(folder_list['Hash_stage'] == 'Partial') &
+                            pd.Series([key in shared_keys for key in zip(folder_list['File_size'], folder_list['File_hash'])], index=folder_list.index, dtype=bool)]
+        folder_list.loc[files.index, 'File_hash'] = run_hashing(calculate_hash, [(folder + f, algorithm) for f, folder in zip(files['File_name'], files['File_folder'])],
+                                                                workers, processes)
+        folder_list.loc[files.index, 'Hash_stage'] = 'Full'
+
+    stages = pd.concat([folder_list1['Hash_stage'], folder_list2['Hash_stage']]).value_counts()
+    logger.debug(f'Files per hash stage: size only {stages.get("Size", 0)}, partial hash {stages.get("Partial", 0)}, full hash {stages.get("Full", 0)}')
+
 logger.add(r'C:\Temp\Files_comparison'+runday+'.log', backtrace=True, diagnose=True, rotation="100 MB", retention="12 months")
 @logger.catch()
 
@@ -114,6 +210,19 @@ def main():
             break
     logger.debug(f'Folder names provided: \n Folder name 1:   ' + pathi1 + '\n Folder name 2:   ' + pathi2)
 
+    # Establish the hash algorithm: BLAKE2b (fastest) or MD5 (the same hashes as earlier results)
+    algorithm = ''
+    while algorithm not in HASH_ALGORITHMS:
+        algorithm = input('Which hash algorithm should be used: blake2b (fastest) or md5 (same as earlier results)?\nPress Enter for blake2b.\n').strip().lower() or 'blake2b'
+    logger.debug('Hash algorithm used: ' + algorithm)
+
+    # Establish how many files are hashed at the same time and if threads or processes are used
+    default_workers = min(32, (os.cpu_count() or 1) + 4)
+    workers = input(f'How many files should be hashed at the same time? Press Enter for {default_workers}.\n')
+    workers = int(workers) if workers.strip() else default_workers
+    processes = input('Should separate processes be used instead of threads (yes/no)? Press Enter for no.\n') == 'yes'
+    logger.debug(f'Files hashed at the same time: {workers} ' + ('processes' if processes else 'threads'))
+
     # Step 2: Establish what files exist in both folders. Put the filenames in a table
     # and add the characteristics to two separate Dataframe. Include hash codes for
     # unique fingerprinting of files to compare on. Python 3 has the built in hashlib library.
@@ -122,35 +231,25 @@ def main():
     folder1 = pathi1
     folder2 = pathi2
 
-    # Get lists of all files only in the given directories
-    overviewlist1 = lambda x: os.path.isfile(os.path.join(folder1, x))
-    files_list1 = filter(overviewlist1, os.listdir(folder1))
-    overviewlist2 = lambda x: os.path.isfile(os.path.join(folder2, x))
-    files_list2 = filter(overviewlist2, os.listdir(folder2))
-
     # Create a list of file characteristics for both folders
-    # Remark: st_ctime is creation time on Windows computers
-    data_of_files1 = [
-        (f, os.stat(os.path.join(folder1, f)).st_size, rdbl_time(os.stat(os.path.join(folder1, f)).st_ctime), rdbl_time(os.stat(os.path.join(folder1, f)).st_mtime), calculate_md5(folder1+f), folder1)
-        for f in files_list1
-    ]
-    data_of_files2 = [
-        (f, os.stat(os.path.join(folder2, f)).st_size, rdbl_time(os.stat(os.path.join(folder2, f)).st_ctime), rdbl_time(os.stat(os.path.join(folder2, f)).st_mtime), calculate_md5(folder2+f), folder2)
-        for f in files_list2
-    ]
+    data_of_files1 = file_characteristics(folder1)
+    data_of_files2 = file_characteristics(folder2)
 
     # Create a table with the list as input
-    folder_list1 = pd.DataFrame(data_of_files1, columns=['File_name', 'File_size', 'Created_on', 'Last_modified', 'File_hash', 'File_folder'])
-    folder_list2 = pd.DataFrame(data_of_files2, columns=['File_name', 'File_size', 'Created_on', 'Last_modified', 'File_hash', 'File_folder'])
+    folder_list1 = pd.DataFrame(data_of_files1, columns=['File_name', 'File_size', 'Created_on', 'Last_modified', 'File_folder'])
+    folder_list2 = pd.DataFrame(data_of_files2, columns=['File_name', 'File_size', 'Created_on', 'Last_modified', 'File_folder'])
+
+    # Add the hash codes (only for files with a size that is in both folders)
+    add_file_hashes(folder_list1, folder_list2, algorithm, workers, processes)
 
     # Compare columns between Dataframes and add yes/no if true
     # df1['isPresent'] = df1['UID'].isin(df2['UID'])
     # Compare both filenames and file hashes for both tables/Dataframes
-    # The new variables contain True or False if a match is found
-    folder_list1['MatchesHash'] = folder_list1['File_hash'].isin(folder_list2['File_hash'])
+    # The new variables contain True or False if a match is found. Only files with a full hash can match on hash.
+    folder_list1['MatchesHash'] = folder_list1['File_hash'].isin(folder_list2['File_hash']) & folder_list1['Hash_stage'].eq('Full')
     folder_list1['MatchesName'] = folder_list1['File_name'].isin(folder_list2['File_name'])
 
-    folder_list2['MatchesHash'] = folder_list2['File_hash'].isin(folder_list1['File_hash'])
+    folder_list2['MatchesHash'] = folder_list2['File_hash'].isin(folder_list1['File_hash']) & folder_list2['Hash_stage'].eq('Full')
     folder_list2['MatchesName'] = folder_list2['File_name'].isin(folder_list1['File_name'])
 
     # Create table Result containing matches
@@ -7,9 +7,25 @@ from loguru import logger
 from datetime import datetime
 import time
 import os
+import gzip
+import json
+import hashlib
+import re
+import unicodedata
+from collections import deque
+from functools import lru_cache
+import multiprocessing
+from multiprocessing.connection import wait
 import pandas as pd
 import PyPDF2
+from Cusip_conversion import checksum as cusip_checksum
 # PyPDF2 requires dependent library for secure PDF files: PyCryptodome
+# resource is used to limit the memory of the worker processes. It does not exist on Windows,
+# so there only the time limit is used.
+try:
+    import resource
+except ImportError:
+    resource = None
 
 # Show all data in screen
 pd.set_option("display.max.columns", None)
@@ -21,77 +37,865 @@ runday = str(datetime.today().date())
 now = str(datetime.now())
 nowt = time.time()
 
+# Files bigger than this (bytes) are split in parts of PAGES_PER_TASK pages, so the pages
+# of a very large file are also spread over the processor cores.
+LARGE_FILE_SIZE = 5 * 1024 * 1024
+PAGES_PER_TASK = 50
+
+# Folder with the text of PDF pages that were extracted before (compressed Json files).
+# Extracting the text is the slow part, so a next search on the same files uses this text.
+CACHE_FOLDER = 'U:\\Werk\\Data Management\\Python\\Files\\output\\PDF_text_cache\\'
+
+# Some PDF files make PyPDF2 run for minutes or use a lot of memory. Each (part of a) file is
+# therefore processed by a supervised worker process with a time limit (seconds) and a memory
+# limit (bytes). A file that goes over a limit is tried again at the end with RETRY_FACTOR times
+# the limits and is written to the skip list. Files on the skip list are processed last next time.
+TASK_TIMEOUT = 300
+TASK_MEMORY_LIMIT = 2 * 1024 ** 3
+RETRY_FACTOR = 4
+SKIP_LIST = 'U:\\Werk\\Data Management\\Python\\Files\\output\\PDF_skip_list.json'
+
+# Function that finds the PDF files (bigger than min_size bytes, to skip empty files with no data / text)
+# in a folder and all its subfolders. Gives (filename, size) with the filename relative to the folder,
+# with modified also the last modified time (nanoseconds).
+# The files are given while the folders are read, so the search can start right away.
+def find_pdfs(folder, min_size=100, extension='.pdf', subfolder='', modified=False):
+    try:
+        entries = sorted(os.scandir(os.path.join(folder, subfolder)), key=lambda entry: entry.name)
+    except OSError as error:
+        logger.warning(f'Folder {os.path.join(folder, subfolder)} could not be read: {error}')
+        return
+    for entry in entries:
+        if entry.is_dir(follow_symlinks=False):
+            yield from find_pdfs(folder, min_size, extension, os.path.join(subfolder, entry.name), modified)
+        elif entry.name.lower().endswith(extension) and entry.is_file():
+            file_stat = entry.stat()
+            if file_stat.st_size > min_size:
+                if modified:
+                    yield os.path.join(subfolder, entry.name), file_stat.st_size, file_stat.st_mtime_ns
+                else:
+                    yield os.path.join(subfolder, entry.name), file_stat.st_size
+
+# Function that keeps watching a folder (and its subfolders) for new or changed PDF files. Every interval
+# seconds it gives the list (filename, size) of the files that are new or changed since the last time.
+# The first time these are all files. A file is only given when it did not change since the previous
+# look or was last changed more than interval seconds ago, so files that are still being copied are
+# left for the next time. seen has the files that were given, with their [size, last modified time].
+WATCH_INTERVAL = 60
+
+def watch_pdfs(searchpath, seen, interval=WATCH_INTERVAL):
+    previous = {}
+    while True:
+        current = {}
+        for filename, file_size, mtime_ns in find_pdfs(searchpath, modified=True):
+            current[filename] = [file_size, mtime_ns]
+        ready_time = (time.time() - interval) * 1e9
+        batch = [(filename, fingerprint[0]) for filename, fingerprint in current.items()
+                 if seen.get(filename) != fingerprint and (previous.get(filename) == fingerprint or fingerprint[1] < ready_time)]
+        for filename in seen.keys() - current.keys():
+            del seen[filename]
+        for filename, file_size in batch:
+            seen[filename] = current[filename]
+        previous = current
+        if batch:
+            yield batch
+        time.sleep(interval)
+
+# Function that makes the name of the cache file for (a part of) a PDF file. The name is based on
+# the location, size and last modified time of the file, so a changed file is extracted again.
+def cache_key(path, first_page, last_page):
+    file_stat = os.stat(path)
+    fingerprint = f'{os.path.abspath(path)}|{file_stat.st_size}|{file_stat.st_mtime_ns}|{first_page}|{last_page}'
+    return hashlib.sha1(fingerprint.encode('utf-8')).hexdigest()
+
+# Function that gives the text of each page (page number, text) of (a part of) a PDF file.
+# The text is taken from the cache if it is there. Otherwise it is extracted with PyPDF2 and
+# saved in the cache once all pages were extracted. last_page None means: until the last page.
+def page_texts(path, first_page=0, last_page=None, cache_folder=CACHE_FOLDER):
+    cachefile = None
+    if cache_folder:
+        cachefile = cache_folder + cache_key(path, first_page, last_page) + '.json.gz'
+        if os.path.exists(cachefile):
+            with gzip.open(cachefile, 'rt', encoding='utf-8') as f:
+                yield from enumerate(json.load(f), start=first_page)
+            return
+        # The text of the whole file may be in the cache (for example when only the first pages are asked for now)
+        wholefile = cache_folder + cache_key(path, 0, None) + '.json.gz'
+        if os.path.exists(wholefile):
+            with gzip.open(wholefile, 'rt', encoding='utf-8') as f:
+                texts = json.load(f)
+            yield from enumerate(texts[first_page:last_page], start=first_page)
+            return
+    # For the PyPDF2 package I need to indicate strict=False because of a bug
+    reader = PyPDF2.PdfReader(path, strict=False)
+    if cache_folder:
+        save_page_count(path, len(reader.pages), cache_folder)
+    if last_page is None or last_page > len(reader.pages):
+        last_page = len(reader.pages)
+    texts = []
+    for page_number in range(first_page, last_page):
+        page = reader.pages[page_number]
+        page_content = page.extract_text()
+        texts.append(page_content)
+        yield page_number, page_content
+    if cachefile:
+        # Write to a temporary file first, so an unfinished cache file is never used
+        with gzip.open(cachefile + '.tmp', 'wt', encoding='utf-8') as f:
+            json.dump(texts, f)
+        os.replace(cachefile + '.tmp', cachefile)
+
+# Function that folds one character: lower case and/or without accents (diacritics).
+# One character can become more (or no) characters, for example a ligature (fi as one character) becomes f + i.
+@lru_cache(maxsize=None)
+def fold_character(character, ignore_case, ignore_accents):
+    if ignore_case:
+        character = character.lower()
+    if ignore_accents:
+        character = ''.join(c for c in unicodedata.normalize('NFKD', character) if not unicodedata.combining(c))
+    return character
+
+# Function that makes text comparable: lower case and/or without accents if asked for.
+# Returns the folded text and for each folded character the position in the original text
+# (None if the positions did not change).
+def fold_text(text, ignore_case=False, ignore_accents=False):
+    if not ignore_accents:
+        folded = text.lower() if ignore_case else text
+        if len(folded) == len(text):
+            return folded, None
+    folded = []
+    positions = []
+    for position, character in enumerate(text):
+        character = fold_character(character, ignore_case, ignore_accents)
+        folded.append(character)
+        positions.extend([position] * len(character))
+    return ''.join(folded), positions
+
+# Function that builds a multi-pattern matcher (Aho-Corasick automaton) for all search terms.
+# The text of a page then only has to be read once, however many search terms there are.
+# goto: the next state for each character, fail: the state to continue with if there is no next
+# state, output: the search terms (number and length) that end in a state.
+def build_matcher(termlist, ignore_case=False, ignore_accents=False):
+    goto = [{}]
+    fail = [0]
+    output = [[]]
+    for termnr, search_term in enumerate(termlist):
+        folded = fold_text(search_term, ignore_case, ignore_accents)[0]
+        if not folded:
+            continue
+        state = 0
+        for character in folded:
+            next_state = goto[state].get(character)
+            if next_state is None:
+                next_state = len(goto)
+                goto.append({})
+                fail.append(0)
+                output.append([])
+                goto[state][character] = next_state
+            state = next_state
+        output[state].append((termnr, len(folded)))
+
+    # Fill the fail states level by level (breadth first)
+    queue = deque(goto[0].values())
+    while queue:
+        state = queue.popleft()
+        for character, next_state in goto[state].items():
+            queue.append(next_state)
+            fail_state = fail[state]
+            while fail_state and character not in goto[fail_state]:
+                fail_state = fail[fail_state]
+            fail_state = goto[fail_state].get(character, 0)
+            fail[next_state] = fail_state if fail_state != next_state else 0
+            output[next_state] = output[next_state] + output[fail[next_state]]
+    return {'terms': list(termlist), 'goto': goto, 'fail': fail, 'output': output,
+            'ignore_case': ignore_case, 'ignore_accents': ignore_accents}
+
+# Function that finds all search terms in a text in one pass. Gives (search term, offset) for
+# every hit, with the offset (position) of the hit in the original text.
+def find_terms(matcher, text):
+    folded, positions = fold_text(text, matcher['ignore_case'], matcher['ignore_accents'])
+    goto, fail, output, terms = matcher['goto'], matcher['fail'], matcher['output'], matcher['terms']
+    state = 0
+    for position, character in enumerate(folded):
+        while state and character not in goto[state]:
+            state = fail[state]
+        state = goto[state].get(character, 0)
+        for termnr, length in output[state]:
+            start = position - length + 1
+            yield terms[termnr], (start if positions is None else positions[start])
+
+# Up to this number of search terms the terms are looked for one at a time with 'in' (if case and accents
+# are not ignored and no offsets are needed): that is done by Python in C and is faster than the automaton.
+# The automaton reads each page once, which is faster with many search terms.
+MATCHER_MIN_TERMS = 500
+
+# Function that gives the search terms found in a text: for each search term the offsets of the hits
+# (with offsets) or None
+def page_hits(matcher, text, offsets=False):
+    terms = matcher['terms']
+    if offsets or matcher['ignore_case'] or matcher['ignore_accents'] or len(terms) >= MATCHER_MIN_TERMS:
+        hits = {}
+        for search_term, offset in find_terms(matcher, text):
+            hits.setdefault(search_term, []).append(offset)
+        return hits
+    return {search_term: None for search_term in terms if search_term and search_term in text}
+
+# Function that searches (a part of) the pages of one PDF file for the search terms with the
+# matcher. This can run in a separate process. Each page gives one result per search term found,
+# in the order of the search terms. With offsets the positions of all hits on the page are added.
+# With first_hit only the first page with a search term is given and the search stops when all
+# search terms were found. With max_hits the search stops after that many results. The text of the
+# remaining pages is then not extracted.
+def search_pages(path, filename, first_page, last_page, matcher, cache_folder=CACHE_FOLDER, offsets=False,
+                 first_hit=False, max_hits=None):
+    results = []
+    termnrs = {search_term: termnr for termnr, search_term in reversed(list(enumerate(matcher['terms'])))}
+    not_found = set(termnrs)
+    for page_number, page_content in page_texts(path, first_page, last_page, cache_folder):
+        hits = page_hits(matcher, page_content, offsets)
+        for search_term in sorted(hits, key=termnrs.get):
+            if first_hit and search_term not in not_found:
+                continue
+            not_found.discard(search_term)
+            result = {
+                "page": page_number,
+                "content": filename,
+                "keyword": search_term
+            }
+            if offsets:
+                result["offsets"] = hits[search_term]
+            results.append(result)
+        if first_hit and not not_found:
+            break
+        if max_hits is not None and len(results) >= max_hits:
+            del results[max_hits:]
+            break
+    return results
+
+# Functions that save and give the number of pages of a PDF file. The number is kept in the cache
+# next to the text of the file (in a small file with the name of the cache file for the whole file),
+# so the file only has to be opened again to count the pages when its text is not in the cache.
+def page_count_file(path, cache_folder):
+    return cache_folder + cache_key(path, 0, None) + '.pages'
+
+def save_page_count(path, pages, cache_folder=CACHE_FOLDER):
+    countfile = page_count_file(path, cache_folder)
+    if not os.path.exists(countfile):
+        # Parts of the same file can be processed at the same time, so each process has its own temporary file
+        with open(f'{countfile}.{os.getpid()}.tmp', 'w') as f:
+            f.write(str(pages))
+        os.replace(f'{countfile}.{os.getpid()}.tmp', countfile)
+
+def count_pages(path, cache_folder=CACHE_FOLDER):
+    if cache_folder:
+        countfile = page_count_file(path, cache_folder)
+        if os.path.exists(countfile):
+            with open(countfile) as f:
+                return int(f.read())
+    pages = len(PyPDF2.PdfReader(path, strict=False).pages)
+    if cache_folder:
+        save_page_count(path, pages, cache_folder)
+    return pages
+
+# Function that gives the part (first page, last page) of a PDF file that starts at first_page.
+# With max_pages only the first max_pages pages of the file are processed.
+def page_range(first_page, max_pages=None):
+    last_page = first_page + PAGES_PER_TASK
+    return first_page, last_page if max_pages is None else min(last_page, max_pages)
+
+# Function that makes the list of tasks: (part of) a PDF file to be processed. The files are given
+# as (number of the file, filename, size). The number of a task is (number of the file, number of
+# the part), so the results can be put in order again. A task is
+# (number, path, filename, first page, last page, count the pages).
+# Large files are processed in parts. Their number of pages is not known yet (opening the file can
+# already take long or fail), so the first part also counts the pages (in the worker process) and the
+# other parts are made with more_page_tasks when that is done.
+def pdf_tasks(searchpath, files, max_pages=None):
+    for filenr, filename, file_size in files:
+        if file_size > LARGE_FILE_SIZE and (max_pages is None or max_pages > PAGES_PER_TASK):
+            yield ((filenr, 0), searchpath + filename, filename) + page_range(0, max_pages) + (True,)
+        else:
+            yield (filenr, 0), searchpath + filename, filename, 0, max_pages, False
+
+# Function that makes the tasks for the other parts of a large file, once the first task counted the pages
+def more_page_tasks(task, pages, max_pages=None):
+    (filenr, partnr), path, filename = task[:3]
+    if max_pages is not None:
+        pages = min(pages, max_pages)
+    for partnr, first_page in enumerate(range(PAGES_PER_TASK, pages, PAGES_PER_TASK), start=1):
+        yield ((filenr, partnr), path, filename) + page_range(first_page, max_pages) + (False,)
+
+# Function that reads the skip list: the PDF files that went over a limit, with their size, last
+# modified time and the reason (timeout, memory, crashed or error)
+def load_skip_list(skipfile):
+    if not skipfile or not os.path.exists(skipfile):
+        return {}
+    with open(skipfile, encoding='utf-8') as f:
+        return json.load(f)
+
+# Function that saves the skip list as a Json file (that can be read to see which files had problems)
+def save_skip_list(skipfile, skiplist):
+    with open(skipfile + '.tmp', 'w', encoding='utf-8') as f:
+        json.dump(skiplist, f, indent=1)
+    os.replace(skipfile + '.tmp', skipfile)
+
+# Function that checks if an unchanged PDF file is on the skip list
+def on_skip_list(skiplist, path):
+    file_stat = os.stat(path)
+    entry = skiplist.get(path)
+    return entry is not None and [entry['size'], entry['mtime_ns']] == [file_stat.st_size, file_stat.st_mtime_ns]
+
+# Function that runs in a worker process: it limits its own memory and then processes the tasks
+# it gets from the supervisor until it gets None. A task that runs out of memory ends the worker.
+# It sends back (status, result, number of pages if the task has to count them).
+def supervised_worker(connection, worker, arguments, memory_limit):
+    if memory_limit and resource is not None:
+        hard_limit = resource.getrlimit(resource.RLIMIT_AS)[1]
+        if hard_limit != resource.RLIM_INFINITY:
+            memory_limit = min(memory_limit, hard_limit)
+        resource.setrlimit(resource.RLIMIT_AS, (memory_limit, hard_limit))
+    while True:
+        task = connection.recv()
+        if task is None:
+            break
+        path, filename, first_page, last_page, count = task
+        try:
+            result = worker(path, filename, first_page, last_page, *arguments)
+            connection.send(('done', result, count_pages(path) if count else None))
+        except MemoryError:
+            connection.send(('memory', None, None))
+            break
+        except Exception as error:
+            connection.send(('error', repr(error), None))
+
+# Function that starts a worker process and gives the process and the connection to it
+def start_worker(worker, arguments, memory_limit):
+    connection, worker_connection = multiprocessing.Pipe()
+    process = multiprocessing.Process(target=supervised_worker, args=(worker_connection, worker, arguments, memory_limit),
+                                      daemon=True)
+    process.start()
+    worker_connection.close()
+    return process, connection
+
+# Function that processes the PDF files with supervised worker processes. The worker function gets
+# (path, filename, first page, last page) and the extra arguments. The results of each task are
+# passed back (yielded) as soon as the task is done, together with the number of the task
+# so the results can be put in the order of the files and pages again. The filelist can be a
+# generator (see find_pdfs): the files are processed while the list is made.
+# Before a task is handed out, skip(filename) is asked if the task is still needed (for example
+# when the question is already answered). Running tasks that are not needed anymore are stopped.
+# A task that takes longer than timeout seconds is stopped, a task that needs more than memory_limit
+# bytes or that crashes the worker ends it. Those tasks are tried again at the end (with higher limits),
+# so one bad file does not hold up the other files. A task that still fails (or gives an error) gives
+# the result None and the file is written to the skip list.
+def run_pdf_tasks(searchpath, filelist, worker, processes, *arguments, skip=None, max_pages=None,
+                  timeout=TASK_TIMEOUT, memory_limit=TASK_MEMORY_LIMIT, skipfile=SKIP_LIST):
+    files = ((filenr, filename, file_size) for filenr, (filename, file_size) in enumerate(filelist))
+    if processes <= 1 and timeout is None and memory_limit is None:
+        for first_task in pdf_tasks(searchpath, files, max_pages):
+            tasks = deque([first_task])
+            while tasks:
+                task = tasks.popleft()
+                tasknr, path, filename, first_page, last_page, count = task
+                if skip and skip(filename):
+                    continue
+                print('Processing file: ', filename)
+                yield tasknr, filename, worker(path, filename, first_page, last_page, *arguments)
+                if count:
+                    tasks.extend(more_page_tasks(task, count_pages(path), max_pages))
+        return
+
+    # Files on the skip list are processed at the end, with the higher limits
+    skiplist = load_skip_list(skipfile)
+    listed = []
+
+    def first_files():
+        for filenr, filename, file_size in files:
+            if on_skip_list(skiplist, searchpath + filename):
+                listed.append((filenr, filename, file_size))
+            else:
+                yield filenr, filename, file_size
+
+    first_tasks = pdf_tasks(searchpath, first_files(), max_pages)
+    retries = deque()
+    # The other parts of large files (with the factor for the limits), once their pages are counted
+    more_tasks = deque()
+
+    # Gives the next task with the factor for the limits, or None if there are no tasks (for now)
+    def next_task():
+        while more_tasks:
+            task, factor = more_tasks.popleft()
+            if not (skip and skip(task[2])):
+                return task, factor
+        for task in first_tasks:
+            if not (skip and skip(task[2])):
+                return task, 1
+        retries.extend(pdf_tasks(searchpath, listed, max_pages))
+        listed.clear()
+        while retries:
+            task = retries.popleft()
+            if not (skip and skip(task[2])):
+                return task, RETRY_FACTOR
+        return None
+
+    idle = {1: [], RETRY_FACTOR: []}
+    busy = {}
+    processed = set()
+    failed = {}
+    try:
+        while True:
+            while len(busy) < processes:
+                next_one = next_task()
+                if next_one is None:
+                    break
+                task, factor = next_one
+                if idle[factor]:
+                    process, connection = idle[factor].pop()
+                else:
+                    process, connection = start_worker(worker, arguments, memory_limit and memory_limit * factor)
+                connection.send(task[1:])
+                deadline = time.monotonic() + timeout * factor if timeout else None
+                busy[connection] = (process, task, factor, deadline)
+            if not busy:
+                break
+
+            deadlines = [deadline for process, task, factor, deadline in busy.values() if deadline is not None]
+            for connection in wait(list(busy), max(0, min(deadlines) - time.monotonic()) if deadlines else None):
+                process, task, factor, deadline = busy.pop(connection)
+                try:
+                    status, result, pages = connection.recv()
+                except EOFError:
+                    status, result, pages = 'crashed', None, None
+                if status in ('done', 'error'):
+                    idle[factor].append((process, connection))
+                else:
+                    process.join()
+                if status == 'done':
+                    print('Processed file: ', task[2])
+                    processed.add(task[2])
+                    if pages is not None:
+                        more_tasks.extend((more_task, factor) for more_task in more_page_tasks(task, pages, max_pages))
+                    yield task[0], task[2], result
+                elif status != 'error' and factor == 1:
+                    logger.warning(f'{task[2]} (pages {task[3]} to {task[4]}): {status}, tried again at the end')
+                    retries.append(task)
+                else:
+                    logger.warning(f'{task[2]} (pages {task[3]} to {task[4]}) was not processed: {result or status}')
+                    failed[task[2]] = status
+                    yield task[0], task[2], None
+
+            # Stop the running tasks that are not needed anymore
+            if skip:
+                for connection, (process, task, factor, deadline) in list(busy.items()):
+                    if skip(task[2]):
+                        del busy[connection]
+                        process.terminate()
+                        process.join()
+
+            # Stop the tasks that take too long
+            for connection, (process, task, factor, deadline) in list(busy.items()):
+                if deadline is not None and time.monotonic() >= deadline:
+                    del busy[connection]
+                    process.terminate()
+                    process.join()
+                    if factor == 1:
+                        logger.warning(f'{task[2]} (pages {task[3]} to {task[4]}): timeout, tried again at the end')
+                        retries.append(task)
+                    else:
+                        logger.warning(f'{task[2]} (pages {task[3]} to {task[4]}) was not processed: timeout')
+                        failed[task[2]] = 'timeout'
+                        yield task[0], task[2], None
+    finally:
+        for workers in idle.values():
+            for process, connection in workers:
+                connection.send(None)
+                process.join()
+        for process, task, factor, deadline in busy.values():
+            process.terminate()
+            process.join()
+
+    # Files that were processed now are taken off the skip list, files that failed are put on it
+    if skipfile:
+        for filename in processed - failed.keys():
+            skiplist.pop(searchpath + filename, None)
+        for filename, reason in failed.items():
+            file_stat = os.stat(searchpath + filename)
+            skiplist[searchpath + filename] = {'size': file_stat.st_size, 'mtime_ns': file_stat.st_mtime_ns,
+                                               'reason': reason, 'date': runday}
+        save_skip_list(skipfile, skiplist)
+
+# Function that searches the PDF files for the search terms, divided over a pool of processes.
+# Returns the results in the order of the files and pages (files that could not be processed are
+# left out, see the skip list). Search modes:
+# first_hit: only the first page per file and search term; max_hits: stop after this many results;
+# max_pages: only search the first pages of each file.
+# With offsets each result also has the positions (offsets) of the hits on the page.
+def search_pdfs(searchpath, filelist, termlist, processes=1, ignore_case=False, ignore_accents=False,
+                first_hit=False, max_hits=None, max_pages=None, offsets=False):
+    matcher = build_matcher(termlist, ignore_case, ignore_accents)
+    found = {}
+    hits = 0
+
+    # A task is not needed anymore when enough results were found or all search terms of the file were found
+    def skip(filename):
+        if max_hits is not None and hits >= max_hits:
+            return True
+        return first_hit and len(found.get(filename, ())) >= len(set(termlist))
+
+    task_results = {}
+    for tasknr, filename, results in run_pdf_tasks(searchpath, filelist, search_pages, processes, matcher, CACHE_FOLDER,
+                                                   offsets, first_hit, max_hits, skip=skip, max_pages=max_pages):
+        if results is None:
+            continue
+        task_results[tasknr] = results
+        hits += len(results)
+        found.setdefault(filename, set()).update(result['keyword'] for result in results)
+
+    result_list = []
+    seen = set()
+    for tasknr in sorted(task_results):
+        for result in task_results[tasknr]:
+            if first_hit:
+                if (result['content'], result['keyword']) in seen:
+                    continue
+                seen.add((result['content'], result['keyword']))
+            result_list.append(result)
+    return result_list if max_hits is None else result_list[:max_hits]
+
+# Identifiers that are collected from the pages in one pass: DOI, ISBN-13 (starts with 978 or 979), ISBN-10
+# (only after the word ISBN, as any number of 10 digits could be one) and CUSIP (after the word CUSIP, or
+# without it when it has a letter, for the same reason). ISBN parts can be separated by a dash or space.
+IDENTIFIER_PATTERN = re.compile(r'''
+    (?P<DOI>\b10\.\d{4,9}/[^\s"'<>]+)
+  | (?P<ISBN13>\b97[89](?:[-\u2010\u2011\u2013\ ]?\d){10}\b)
+  | ISBN(?:-?10)?[:\s]*(?P<ISBN10>\b\d(?:[-\u2010\u2011\u2013\ ]?\d){8}[-\u2010\u2011\u2013\ ]?[\dXx]\b)
+  | CUSIP[:\s#]*(?P<CUSIP>\b[0-9]{3}[0-9A-Z]{5}[0-9]\b)
+  | (?P<CUSIP_LETTER>\b(?=[0-9]{3}[0-9]{0,4}[A-Z])[0-9]{3}[0-9A-Z]{5}[0-9]\b)
+''', re.VERBOSE)
+
+# Function that checks an identifier that was found and gives it in the standard form (ISBN without
+# dashes, DOI in lower case) with its type, or None if the check digit is not correct.
+def check_identifier(kind, identifier):
+    if kind == 'DOI':
+        # Punctuation after the DOI belongs to the sentence, a closing bracket only if it has no opening bracket
+        identifier = identifier.rstrip('.,;:')
+        while identifier[-1] in ')]' and identifier.count(identifier[-1]) > identifier.count('(' if identifier[-1] == ')' else '['):
+            identifier = identifier[:-1].rstrip('.,;:')
+        return identifier.lower(), 'DOI'
+    if kind.startswith('ISBN'):
+        digits = [10 if c in 'Xx' else int(c) for c in identifier if c.isdigit() or c in 'Xx']
+        if len(digits) == 13:
+            valid = sum(d * (3 if i % 2 else 1) for i, d in enumerate(digits)) % 10 == 0
+        else:
+            valid = 10 not in digits[:9] and sum(d * (10 - i) for i, d in enumerate(digits)) % 11 == 0
+        return (''.join('X' if d == 10 else str(d) for d in digits), 'ISBN') if valid else None
+    if cusip_checksum(identifier[:8]) == identifier[8]:
+        return identifier, 'CUSIP'
+    return None
+
+# Function that collects the identifiers (ISBN, DOI, CUSIP) on (a part of) the pages of a PDF file.
+# This can run in a separate process. Each identifier is given once per page.
+def harvest_pages(path, filename, first_page, last_page, cache_folder=CACHE_FOLDER):
+    results = []
+    for page_number, page_content in page_texts(path, first_page, last_page, cache_folder):
+        found = set()
+        for match in IDENTIFIER_PATTERN.finditer(page_content):
+            checked = check_identifier(match.lastgroup, match.group(match.lastgroup))
+            if checked and checked not in found:
+                found.add(checked)
+                results.append({"identifier": checked[0], "type": checked[1], "file": filename, "page": page_number})
+    return results
+
+# Function that collects the identifiers in the PDF files, divided over a pool of processes.
+# Returns the (identifier, type, file, page) results in the order of the files and pages.
+def harvest_pdfs(searchpath, filelist, processes=1):
+    task_results = {}
+    for tasknr, filename, results in run_pdf_tasks(searchpath, filelist, harvest_pages, processes, CACHE_FOLDER):
+        if results is not None:
+            task_results[tasknr] = results
+    return [result for tasknr in sorted(task_results) for result in task_results[tasknr]]
+
+# Function that splits text in words (lower case) for the page index
+def tokenize(text):
+    return re.findall(r'\w+', text.lower())
+
+# Function that lists for each word on (a part of) the pages of a PDF file the pages with that word.
+# This can run in a separate process.
+def index_pages(path, filename, first_page, last_page, cache_folder=CACHE_FOLDER):
+    postings = {}
+    for page_number, page_content in page_texts(path, first_page, last_page, cache_folder):
+        for term in set(tokenize(page_content)):
+            postings.setdefault(term, []).append(page_number)
+    return postings
+
+# Function that reads the page index of a folder. The index has the files with their size and last
+# modified time (files) and for each word the files and pages that have the word (terms).
+def load_page_index(indexfile):
+    if not os.path.exists(indexfile):
+        return {'files': {}, 'terms': {}}
+    with gzip.open(indexfile, 'rt', encoding='utf-8') as f:
+        return json.load(f)
+
+# Function that saves the page index as a (compressed) Json file
+def save_page_index(indexfile, index):
+    with gzip.open(indexfile + '.tmp', 'wt', encoding='utf-8') as f:
+        json.dump(index, f)
+    os.replace(indexfile + '.tmp', indexfile)
+
+# Function that takes files out of the page index
+def remove_from_page_index(index, filenames):
+    if filenames:
+        for term in list(index['terms']):
+            postings = index['terms'][term]
+            for filename in filenames & postings.keys():
+                del postings[filename]
+            if not postings:
+                del index['terms'][term]
+        for filename in filenames:
+            index['files'].pop(filename, None)
+
+# Function that brings the page index up to date with the files in the folder: files that were
+# removed or changed are taken out of the index and new or changed files are (re)indexed.
+# Files that could not be processed are left out, so they are tried again next time.
+# Returns the number of files that were (re)indexed.
+def update_page_index(index, searchpath, filelist, processes=1):
+    current = {}
+    for filename, file_size in filelist:
+        current[filename] = [int(file_size), os.stat(searchpath + filename).st_mtime_ns]
+    remove_from_page_index(index, {filename for filename, fingerprint in index['files'].items()
+                                   if current.get(filename) != fingerprint})
+    todo = [(filename, fingerprint[0]) for filename, fingerprint in current.items() if filename not in index['files']]
+    failed = set()
+    for tasknr, filename, postings in run_pdf_tasks(searchpath, todo, index_pages, processes):
+        if postings is None:
+            failed.add(filename)
+            continue
+        for term, pages in postings.items():
+            index['terms'].setdefault(term, {}).setdefault(filename, []).extend(pages)
+    for filename, file_size in todo:
+        index['files'][filename] = current[filename]
+    # The pages of (parts of) failed files that were indexed are taken out again
+    remove_from_page_index(index, failed)
+    return len(todo) - len(failed)
+
+# Function that gives the text of one page of a PDF file (from the text cache if possible)
+def page_text(path, file_size, page):
+    if file_size > LARGE_FILE_SIZE:
+        first_page = page // PAGES_PER_TASK * PAGES_PER_TASK
+        last_page = first_page + PAGES_PER_TASK
+    else:
+        first_page, last_page = 0, None
+    for page_number, page_content in page_texts(path, first_page, last_page):
+        if page_number == page:
+            return page_content
+    return ''
+
+# Function that finds the pages (per file) with all words of a search term. A search term with more
+# than one word (or between "quotes") is a phrase: the words have to be next to each other in that
+# order, which is checked on the text of the pages that have all words.
+# With filenames only those files are searched.
+def query_phrase(index, phrase, searchpath, filenames=None):
+    terms = tokenize(phrase)
+    if not terms:
+        return {}
+    found = None
+    for term in terms:
+        postings = {filename: set(pages) for filename, pages in index['terms'].get(term, {}).items()
+                    if filenames is None or filename in filenames}
+        found = postings if found is None else {filename: found[filename] & pages
+                                                 for filename, pages in postings.items() if filename in found}
+        found = {filename: pages for filename, pages in found.items() if pages}
+    if len(terms) > 1:
+        phrase_text = ' ' + ' '.join(terms) + ' '
+        for filename, pages in found.items():
+            file_size = index['files'][filename][0]
+            found[filename] = {page for page in pages
+                               if phrase_text in ' ' + ' '.join(tokenize(page_text(searchpath + filename, file_size, page))) + ' '}
+        found = {filename: pages for filename, pages in found.items() if pages}
+    return found
+
+# Function that answers a query with the page index. A query can combine search terms with AND
+# and OR (AND goes first), for example: payment AND "electronic money" OR e-money
+# The index works with whole words and is not case sensitive.
+# Returns for each file the (sorted) page numbers that match the query.
+def query_page_index(index, query, searchpath, filenames=None):
+    result = {}
+    for alternative in re.split(r'\s+OR\s+', query.strip()):
+        found = None
+        for part in re.split(r'\s+AND\s+', alternative):
+            pages = query_phrase(index, part.strip().strip('"'), searchpath, filenames)
+            found = pages if found is None else {filename: found[filename] & pages[filename]
+                                                 for filename in found.keys() & pages.keys()}
+        for filename, pages in (found or {}).items():
+            result.setdefault(filename, set()).update(pages)
+    return {filename: sorted(pages) for filename, pages in result.items() if pages}
+
+# Function that makes the search result (page, content, keyword) for each search term with the page index
+# (only for the files in filenames if given)
+def index_results(index, termlist, searchpath, filenames=None):
+    result_list = []
+    for search_term in termlist:
+        for filename, pages in sorted(query_page_index(index, search_term, searchpath, filenames).items()):
+            for page_number in pages:
+                result_list.append({"page": page_number, "content": filename, "keyword": search_term})
+    return result_list
+
 logger.add(r'U:\Werk\Data Management\Python\\Files\output\PDF_Search.log', backtrace=True, diagnose=True, rotation="10 MB", retention="12 months")
 @logger.catch()
 
 def main():
-    # Determine the number of terms to be searched
-    termnumber = input('How many keywords do you want?\n')
-    termnumber = int(termnumber)
+    # Establish if keywords are searched or the identifiers (ISBN, DOI, CUSIP) in the files are collected
+    task = ''
+    while task not in ('1', '2'):
+        task = input('Do you want to search for keywords (1) or collect the identifiers (ISBN, DOI, CUSIP) in the files (2)?\nPlease enter your choice (1 or 2):')
 
-    # Now create the termlist by input of search terms
     termlist = []
-    while termnumber != 0:
-        Newterm = input('Add a new search term to the list: ')
-        termlist.append(Newterm)
-        termnumber = termnumber - 1
+    if task == '1':
+        # Determine the number of terms to be searched
+        termnumber = input('How many keywords do you want?\n')
+        termnumber = int(termnumber)
+
+        # Now create the termlist by input of search terms
+        while termnumber != 0:
+            Newterm = input('Add a new search term to the list: ')
+            termlist.append(Newterm)
+            termnumber = termnumber - 1
 
-    # Establish location and files with data. Put the filenames in a table
+    # Establish location of the files with data. The subfolders are also searched.
     searchpath = input('What is the location of the PDF files on the computer (folder)?\n')
-    dir_path = searchpath
 
     # Establish what type of documents are to be searched
     document_type = input('What type of PDF files are searched ? Example: papers\n')
 
+    # Establish how many processes (processor cores) are used to search the files
+    cores = os.cpu_count() or 1
+    processes = input(f'How many processes (processor cores) should be used? This computer has {cores}.\nPress Enter to use all of them.\n')
+    processes = int(processes) if processes.strip() else cores
+
+    # Establish if the page index is used. The index is kept for the type of documents and is
+    # updated with new or changed files. Search terms can then also use AND, OR and "phrases".
+    use_index = 'no'
+    if task == '1':
+        use_index = input('Do you want to use the page index (whole words, not case sensitive) (yes/no)?\n')
+    if task == '1' and use_index != 'yes':
+        ignore_case = input('Should the search ignore upper / lower case (yes/no)?\n') == 'yes'
+        ignore_accents = input('Should the search ignore accents, for example e = é (yes/no)?\n') == 'yes'
+        # Search modes to answer a question faster: pages that are not needed are not read
+        search_mode = ''
+        while search_mode not in ('1', '2', '3'):
+            search_mode = input('Do you want all hits (1), only the first hit per file and keyword (2)\nor stop after a number of hits (3)? Please enter your choice (1, 2 or 3):')
+        max_hits = int(input('After how many hits should the search stop?\n')) if search_mode == '3' else None
+        max_pages = input('How many pages of each file should be searched? Press Enter for all pages.\n')
+        max_pages = int(max_pages) if max_pages.strip() else None
+        offsets = input('Do you want the positions (offsets) of the hits on the page in the result (yes/no)?\n') == 'yes'
+
+    # Establish if the script keeps running and searches new or changed files in the folder when they arrive
+    watch = 'no'
+    if task == '1':
+        watch = input('Do you want to keep watching the folder for new or changed PDF files (yes/no)?\nThe search can then be stopped with Ctrl+C.\n')
+
+    # Create the folder for the extracted text if it does not exist yet
+    Path(CACHE_FOLDER).mkdir(parents=True, exist_ok=True)
+
     # Start search indicator
     logger.debug('Start search through the PDF files at: ' + now)
 
-    # Get list of all files only in the given directory
-    document = lambda x: os.path.isfile(os.path.join(dir_path, x))
-    document_list = filter(document, os.listdir(dir_path))
-
-    # Create a list of files in directory along with the size
-    document_newlist_g = [
-        (f, os.stat(os.path.join(dir_path, f)).st_size)
-        for f in document_list
-    ]
-
-    # Create a DataFrame with the list as input
-    document_newlist = pd.DataFrame(document_newlist_g, columns=['Filename', 'File_size'])
-    # Limit to just the PDF files in the list
-    newlist = document_newlist[document_newlist['Filename'].str.contains('.pdf')]
-    # Exclude possible empty files with no data / text
-    finallist = newlist[newlist['File_size']>100].copy()
-    filenrsf = finallist.shape[0]
-    print('Number of PDF files to be searched: ', filenrsf)
+    # The PDF files in the folder and its subfolders (without empty files) are searched while they are found
+    filenrsf = 0
+    def counted(files):
+        nonlocal filenrsf
+        for filename, file_size in files:
+            filenrsf += 1
+            yield filename, file_size
 
-    result_list = []
-    for filename in finallist['Filename'].values:
-        print('Processing file: ', filename)
-        # For the PyPDF2 package I need to indicate strict=False because of a bug
-        reader = PyPDF2.PdfReader(searchpath + filename, strict=False)
-        for page_number in range(0, len(reader.pages)):
-            page = reader.pages[page_number]
-            page_content = page.extract_text()
-            for search_term in termlist:
-                if search_term in page_content:
-                    result = {
-                        "page": page_number,
-                        "content": filename,
-                        "keyword": search_term
-                    }
-                    result_list.append(result)
-
-    # Create a group based on papers and search term count
-    if len(result_list) < 100:
-        print('Keyword(s) were not found in the PDF files.')
-        logger.debug('Keyword(s) were not found in the PDF files.')
+    if use_index == 'yes':
+        indexfile = f'U:\\Werk\\Data Management\\Python\\Files\\output\\{document_type}_page_index.json.gz'
+        index = load_page_index(indexfile)
+
+    # Function that searches the files in the filelist. With the page index, the index is brought
+    # up to date with the files and the search terms are answered with it (for filenames if given).
+    def search_files(filelist, filenames=None):
+        if use_index == 'yes':
+            indexed = update_page_index(index, searchpath, filelist, processes)
+            save_page_index(indexfile, index)
+            logger.debug(f'Files (re)indexed: {indexed}, files in the index: {len(index["files"])}')
+            return index_results(index, termlist, searchpath, filenames)
+        # Search the files, divided over the number of processes that was asked for
+        return search_pdfs(searchpath, filelist, termlist, processes,
+                           ignore_case, ignore_accents, search_mode == '2', max_hits, max_pages, offsets)
+
+    resultfile = f'U:\Werk\Data Management\Python\\Files\output\{document_type}_TermSearch_{runday}.csv'
+    countfile = f'U:\Werk\Data Management\Python\\Files\output\{document_type}_term_count_{runday}.csv'
+    if task == '2':
+        # Collect the identifiers. The list (identifier, type, file, page) is also saved as an Excel file with
+        # one row per identifier, that can be used as input for the lookup tools with sheet name Sheet1:
+        # Google_Books_publishers_tool uses ISBN and Publisher, RIS_on_DOI_or_ISBN uses Course code (here the
+        # type of documents), ISBN, DOI and Title (here the first file with the identifier).
+        identifier_list = harvest_pdfs(searchpath, counted(find_pdfs(searchpath)), processes)
+        print('Number of PDF files searched: ', filenrsf)
+        identifiers = pd.DataFrame(identifier_list, columns=['identifier', 'type', 'file', 'page'])
+        print(f'Identifiers found: {len(identifiers)}, unique identifiers: {identifiers["identifier"].nunique()}')
+        logger.debug(f'Identifiers found: {len(identifiers)}, unique identifiers: {identifiers["identifier"].nunique()}')
+        identifiers.to_csv(f'U:\Werk\Data Management\Python\\Files\output\{document_type}_identifiers_{runday}.csv', encoding='utf-8')
+        lookup_list = identifiers.drop_duplicates(['identifier', 'type'])
+        lookup_list = lookup_list.pivot(columns='type', values='identifier').reindex(columns=['ISBN', 'DOI', 'CUSIP']).rename_axis(columns=None)
+        lookup_list.insert(0, 'Course code', document_type)
+        lookup_list.insert(3, 'Title', identifiers.drop_duplicates(['identifier', 'type'])['file'])
+        lookup_list['Publisher'] = None
+        lookup_list.to_excel(f'U:\Werk\Data Management\Python\\Files\output\{document_type}_identifiers_{runday}.xlsx', index=False)
+    elif watch == 'yes':
+        # Only new or changed files are searched. Their results are added to the results (file) so far.
+        # The earlier results of a changed or removed file are taken out first; the results file is then
+        # written again, otherwise the new results are added to the end of it.
+        result_list = []
+        seen = {}
+        searched = set()
+        try:
+            for batch in watch_pdfs(searchpath, seen):
+                filelist = [(filename, fingerprint[0]) for filename, fingerprint in seen.items()] if use_index == 'yes' else batch
+                batch_files = {filename for filename, file_size in batch}
+                new_results = search_files(filelist, batch_files)
+                print(f'New or changed PDF files searched: {len(batch)}, new results: {len(new_results)}')
+                logger.debug(f'New or changed PDF files searched: {len(batch)}, new results: {len(new_results)}')
+                outdated = (batch_files & searched) | (searched - seen.keys())
+                searched = set(seen)
+                old_length = len(result_list)
+                if outdated:
+                    result_list = [result for result in result_list if result['content'] not in outdated]
+                if len(result_list) < old_length:
+                    result_list.extend(new_results)
+                    if result_list:
+                        pd.DataFrame.from_dict(result_list).to_csv(resultfile, encoding='utf-8')
+                    else:
+                        pd.DataFrame(columns=['page', 'content', 'keyword']).to_csv(resultfile, encoding='utf-8')
+                elif new_results:
+                    result_list_new = pd.DataFrame.from_dict(new_results)
+                    result_list_new.index += len(result_list)
+                    result_list_new.to_csv(resultfile, mode='a' if result_list else 'w', header=not result_list, encoding='utf-8')
+                    result_list.extend(new_results)
+                else:
+                    continue
+                if result_list:
+                    result_temp = pd.DataFrame.from_dict(result_list).groupby(['content', 'keyword'], as_index=False).count()
+                else:
+                    result_temp = pd.DataFrame(columns=['content', 'keyword', 'page'])
+                result_temp.to_csv(countfile, encoding='utf-8')
+        except KeyboardInterrupt:
+            print('Watching the folder stopped.')
+        logger.debug(f'Results found while watching the folder: {len(result_list)}')
     else:
-        result_list_new = pd.DataFrame.from_dict(result_list)
-        result_list_new.to_csv(f'U:\Werk\Data Management\Python\\Files\output\{document_type}_TermSearch_{runday}.csv', encoding='utf-8')
-        result_temp = result_list_new.groupby(['content', 'keyword'], as_index=False).count()
-        print('Paper overview:\n', result_temp.head())
-        result_temp.to_csv(f'U:\Werk\Data Management\Python\\Files\output\{document_type}_term_count_{runday}.csv', encoding='utf-8')
+        result_list = search_files(counted(find_pdfs(searchpath)))
+        print('Number of PDF files searched: ', filenrsf)
+
+        # Create a group based on papers and search term count
+        if not result_list:
+            print('Keyword(s) were not found in the PDF files.')
+            logger.debug('Keyword(s) were not found in the PDF files.')
+        else:
+            result_list_new = pd.DataFrame.from_dict(result_list)
+            result_list_new.to_csv(resultfile, encoding='utf-8')
+            result_temp = result_list_new.groupby(['content', 'keyword'], as_index=False).count()
+            print('Paper overview:\n', result_temp.head())
+            result_temp.to_csv(countfile, encoding='utf-8')
 
     logger.debug('Location of PDF files / Folder searched : ' + searchpath)
     # Logging of script run: